@@ -0,0 +1,311 @@
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+import requests
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+# 用法：python benchmark.py --club-size 2000 --poll-rate 5 --duration 60
+# 在本地启动一个模拟的Racenet服务，让server.py连接它，然后按设定的频率调用/get_simhub_data，最后输出性能数据
+
+############################################################################################
+#
+# 模拟的Racenet服务：实现server.py用到的identity、wrc2023clubs和wrc2023Stats接口
+#
+############################################################################################
+class FakeRacenet:
+    def __init__(self, club_count, club_size, time_trial_size, stages, max_page_size, latency_ms, jitter_ms, error_rate, churn, rate_limit=0):
+        self.club_count = club_count
+        self.club_size = club_size
+        self.time_trial_size = time_trial_size
+        self.max_page_size = max_page_size
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.churn = churn
+        self.rate_limit = rate_limit
+
+        self.lock = threading.Lock()
+        self.request_counts = {}
+        self.bytes_sent = 0
+        self.throttled = 0
+        self.recent_requests = collections.deque()
+
+        # routeID -> route name, every club runs the same championship on these stages
+        self.routes = {str(100 + i): f'Benchmark Stage {chr(ord("A") + i)}' for i in range(stages)}
+        self.clubs = {str(1000 + i): {
+            'clubID': str(1000 + i),
+            'clubName': f'Benchmark Club {i}',
+            'leaderboards': {str(uuid.UUID(int=(i << 32) + int(route_id))): route_id for route_id in self.routes}
+        } for i in range(club_count)}
+        self.boards = {}
+
+        self.app = Flask('fake_racenet')
+        self.app.add_url_rule('/api/identity/refresh-auth', 'refresh_auth', self.refresh_auth, methods=['POST'])
+        self.app.add_url_rule('/api/identity/secured', 'secured', self.secured)
+        self.app.add_url_rule('/api/wrc2023clubs/memberships/active', 'memberships', self.memberships)
+        self.app.add_url_rule('/api/wrc2023clubs/<club_id>', 'club', self.club)
+        self.app.add_url_rule('/api/wrc2023clubs/<club_id>/leaderboard/<leaderboard_id>', 'club_leaderboard', self.club_leaderboard)
+        self.app.add_url_rule('/api/wrc2023Stats/values', 'values', self.values)
+        self.app.add_url_rule('/api/wrc2023Stats/leaderboard/<stage_id>/<vehicle_class_id>/<surface_condition_id>', 'time_trial_leaderboard', self.time_trial_leaderboard)
+        self.app.before_request(self.before_request)
+        self.app.after_request(self.after_request)
+
+    def before_request(self):
+        with self.lock:
+            endpoint = request.url_rule.endpoint if request.url_rule else 'unknown'
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+            # Throttle like Racenet when more than rate_limit requests arrive within a second
+            now = time.time()
+            while self.recent_requests and self.recent_requests[0] <= now - 1:
+                self.recent_requests.popleft()
+            self.recent_requests.append(now)
+            if self.rate_limit and len(self.recent_requests) > self.rate_limit:
+                self.throttled += 1
+                return jsonify({'error': 'Too many requests'}), 429, {'Retry-After': '1'}
+        delay = max(0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        time.sleep(delay)
+        if random.random() < self.error_rate:
+            return jsonify({'error': 'Injected error'}), 503
+
+    def after_request(self, response):
+        with self.lock:
+            self.bytes_sent += response.calculate_content_length() or 0
+        return response
+
+    def make_board(self, size):
+        return [{
+            'rank': i + 1,
+            'displayName': 'BenchmarkDriver' if i == size // 2 else f'Driver {i:05d}',
+            'time': f'00:{4 + i // 600:02d}:{(i // 10) % 60:02d}.{(i * 37) % 1000:03d}0000',
+            'differenceToFirst': f'00:00:{(i // 10) % 60:02d}.{(i * 37) % 1000:03d}0000',
+            'nationalityID': i % 50,
+            'timePenalty': '00:00:00',
+            'vehicle': 'Benchmark Car',
+            'points': max(0, 30 - i),
+            'platform': i % 3,
+            'splits': [f'00:0{split}:{(i + split) % 60:02d}.0000000' for split in range(1, 5)]
+        } for i in range(size)]
+
+    def get_board(self, key, size):
+        with self.lock:
+            board = self.boards.get(key)
+            if board is None:
+                board = self.boards[key] = self.make_board(size)
+            # Sometimes a driver improves and swaps places with the one ahead
+            elif random.random() < self.churn:
+                i = random.randrange(1, len(board))
+                board[i - 1], board[i] = dict(board[i], rank=i), dict(board[i - 1], rank=i + 1)
+            return list(board)
+
+    def page(self, board, size_param, cursor_param, focus_param):
+        size = int(request.args.get(size_param, 20))
+        if size > self.max_page_size:
+            return jsonify({'error': f'{size_param} too large'}), 400
+        start = int(request.args.get(cursor_param) or 0)
+        # focusOnMe returns the page centred on the driver
+        if request.args.get(focus_param) == 'true':
+            my_index = next((i for i, entry in enumerate(board) if entry['displayName'] == 'BenchmarkDriver'), 0)
+            start = max(0, my_index - size // 2)
+        end = start + size
+        return jsonify({'entries': board[start:end], 'next': str(end) if end < len(board) else None, 'totalEntryCount': len(board)})
+
+    def refresh_auth(self):
+        return jsonify({'access_token': 'benchmark-access-token', 'refresh_token': 'benchmark-refresh-token', 'expires_in': 3600})
+
+    def secured(self):
+        return jsonify({'displayName': 'BenchmarkDriver'})
+
+    def memberships(self):
+        take = int(request.args.get('take', 20))
+        skip = int(request.args.get('skip', 0))
+        clubs = [{'clubID': club['clubID'], 'clubName': club['clubName']} for club in self.clubs.values()]
+        return jsonify({'totalActiveMemberships': len(clubs), 'activeMemberships': clubs[skip:skip + take]})
+
+    def club(self, club_id):
+        club = self.clubs.get(club_id)
+        if club is None:
+            return jsonify({'error': 'Club not found'}), 404
+        stages = [{
+            'leaderboardID': leaderboard_id,
+            'stageSettings': {'routeID': int(route_id), 'route': self.routes[route_id], 'weatherAndSurface': 'Dry', 'timeOfDay': 'Morning', 'serviceArea': 'None', 'distance': 10.0}
+        } for leaderboard_id, route_id in club['leaderboards'].items()]
+        return jsonify({
+            'clubID': club_id,
+            'clubName': club['clubName'],
+            'currentChampionship': {'events': [{'eventSettings': {'vehicleClassID': 1}, 'absoluteCloseDate': '2099-01-01T00:00:00Z', 'stages': stages}]}
+        })
+
+    def club_leaderboard(self, club_id, leaderboard_id):
+        return self.page(self.get_board(('club', club_id, leaderboard_id), self.club_size), 'MaxResultCount', 'Cursor', 'FocusOnMe')
+
+    def values(self):
+        return jsonify({'routes': self.routes})
+
+    def time_trial_leaderboard(self, stage_id, vehicle_class_id, surface_condition_id):
+        return self.page(self.get_board(('time_trial', stage_id, vehicle_class_id, surface_condition_id), self.time_trial_size), 'maxResultCount', 'cursor', 'focusOnMe')
+
+def serve_in_thread(app, port):
+    http_server = make_server('127.0.0.1', port, app, threaded=True)
+    thread = threading.Thread(target=http_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return http_server
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+############################################################################################
+#
+# 压测：让server.py连接模拟服务，按设定的频率调用/get_simhub_data，并定期切换赛段
+#
+############################################################################################
+def run_benchmark(args):
+    fake = FakeRacenet(args.clubs, args.club_size, args.time_trial_size, args.stages, args.max_page_size, args.latency_ms, args.jitter_ms, args.error_rate, args.churn, args.rate_limit)
+    fake_server = serve_in_thread(fake.app, args.fake_port)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    # server.py works in the current directory, so give it a clean one
+    work_dir = tempfile.mkdtemp(prefix='racenet_benchmark_')
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    shutil.copy(os.path.join(repo_dir, 'racenet_carClasses.json'), work_dir)
+    os.chdir(work_dir)
+    os.environ['RACENET_API_BASE'] = f'http://127.0.0.1:{args.fake_port}/api'
+    sys.path.insert(0, repo_dir)
+    import server
+
+    server.TRACE_LOG = os.path.join(work_dir, 'racenet_trace.jsonl')
+    if args.window:
+        server.LEADERBOARD_FETCH_MODE = {'club': 'window', 'time_trial': 'window'}
+    server.refresh_token = 'benchmark-refresh-token'
+    server.start_refresh_token_thread()
+    server.start_pre_data_fetching_thread()
+    server.start_refresh_scheduler_thread()
+    server.start_generation_worker_thread()
+    racenet_server = serve_in_thread(server.app, args.port)
+
+    # Wait for the startup data before polling
+    while not (server.access_token and os.path.exists('racenet_club_list_data.json')):
+        time.sleep(0.1)
+    startup_requests = dict(fake.request_counts)
+    startup_bytes = fake.bytes_sent
+
+    vehicle_id = next(iter(server.load_vehicle_class_index()))
+    track_names = list(fake.routes.values())
+    session = requests.Session()
+    poll_latencies = []
+    errors = 0
+
+    print(f"Benchmarking for {args.duration}s at {args.poll_rate} polls/s from {args.sessions} session(s), switching stage every {args.switch_interval}s")
+    started = time.time()
+    next_poll = started
+    while time.time() - started < args.duration:
+        # Each session is a driver in a different club, taking turns to poll
+        club_name = fake.clubs[str(1000 + len(poll_latencies) % args.sessions)]['clubName']
+        track_name = track_names[int((time.time() - started) // args.switch_interval) % len(track_names)]
+        url = f'http://127.0.0.1:{args.port}/get_simhub_data/clubName={club_name}&trackName={track_name}&vehicleID={vehicle_id}'
+        poll_started = time.time()
+        try:
+            if session.get(url, timeout=10).status_code != 200:
+                errors += 1
+        except requests.RequestException:
+            errors += 1
+        poll_latencies.append(time.time() - poll_started)
+        next_poll += 1 / args.poll_rate
+        time.sleep(max(0, next_poll - time.time()))
+    elapsed = time.time() - started
+
+    # Let the last refresh finish
+    time.sleep(server.GENERATION_DEBOUNCE + 1)
+
+    refresh_latencies = []
+    if os.path.exists(server.TRACE_LOG):
+        with open(server.TRACE_LOG, 'r', encoding='utf-8') as f:
+            for line in f:
+                for event in json.loads(line)['traceEvents']:
+                    if event['name'] == 'racenet_generate_seconds' and event['args'].get('output') == 'all':
+                        refresh_latencies.append(event['dur'] / 1e6)
+
+    # Only count what the polling caused, not the startup fetches
+    upstream_by_endpoint = {endpoint: count - startup_requests.get(endpoint, 0) for endpoint, count in fake.request_counts.items() if count > startup_requests.get(endpoint, 0)}
+    upstream_requests = sum(upstream_by_endpoint.values())
+    results = {
+        'polls': len(poll_latencies),
+        'pollErrors': errors,
+        'throughput': len(poll_latencies) / elapsed,
+        'pollLatencyP50': percentile(poll_latencies, 50),
+        'pollLatencyP99': percentile(poll_latencies, 99),
+        'refreshes': len(refresh_latencies),
+        'refreshLatencyP50': percentile(refresh_latencies, 50),
+        'refreshLatencyP99': percentile(refresh_latencies, 99),
+        'refreshLatencyMean': statistics.mean(refresh_latencies) if refresh_latencies else None,
+        'upstreamRequests': upstream_requests,
+        'upstreamRequestsPerSecond': upstream_requests / elapsed,
+        'upstreamRequestsByEndpoint': upstream_by_endpoint,
+        'upstreamBytes': fake.bytes_sent - startup_bytes,
+        'upstreamThrottled': fake.throttled,
+        'outputWrites': server.output_write_stats['written'],
+        'outputWritesSkipped': server.output_write_stats['skipped'],
+        'outputBytesWritten': server.output_write_stats['bytesWritten']
+    }
+
+    racenet_server.shutdown()
+    fake_server.shutdown()
+    os.chdir(repo_dir)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def print_results(results):
+    def ms(value):
+        return f"{value * 1000:.1f} ms" if value is not None else 'n/a'
+
+    print(f"Polls:               {results['polls']} ({results['throughput']:.1f}/s, {results['pollErrors']} errors)")
+    print(f"Poll latency:        p50 {ms(results['pollLatencyP50'])}, p99 {ms(results['pollLatencyP99'])}")
+    print(f"Refreshes:           {results['refreshes']}")
+    print(f"Refresh latency:     p50 {ms(results['refreshLatencyP50'])}, p99 {ms(results['refreshLatencyP99'])}, mean {ms(results['refreshLatencyMean'])}")
+    print(f"Upstream requests:   {results['upstreamRequests']} ({results['upstreamRequestsPerSecond']:.2f}/s, {results['upstreamBytes']} bytes, {results['upstreamThrottled']} throttled)")
+    for endpoint, count in sorted(results['upstreamRequestsByEndpoint'].items()):
+        print(f"    {endpoint}: {count}")
+    print(f"Output files:        {results['outputWrites']} written, {results['outputWritesSkipped']} skipped, {results['outputBytesWritten']} bytes")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark server.py against a local fake Racenet service')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to poll for')
+    parser.add_argument('--poll-rate', type=float, default=4, help='/get_simhub_data calls per second')
+    parser.add_argument('--switch-interval', type=float, default=10, help='seconds between stage changes')
+    parser.add_argument('--sessions', type=int, default=1, help='SimHub clients polling at the same time, each in a different club')
+    parser.add_argument('--clubs', type=int, default=30, help='number of clubs the driver is a member of')
+    parser.add_argument('--club-size', type=int, default=1000, help='entries on each club leaderboard')
+    parser.add_argument('--time-trial-size', type=int, default=200, help='entries on each time trial leaderboard')
+    parser.add_argument('--stages', type=int, default=6, help='stages in the club championship')
+    parser.add_argument('--max-page-size', type=int, default=100, help='largest page size the fake API accepts')
+    parser.add_argument('--latency-ms', type=float, default=80, help='latency added to every fake API response')
+    parser.add_argument('--jitter-ms', type=float, default=20, help='random jitter on top of the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of fake API responses that fail with 503')
+    parser.add_argument('--rate-limit', type=int, default=0, help='fake API requests per second before it answers 429, 0 for no limit')
+    parser.add_argument('--churn', type=float, default=0.2, help='chance a leaderboard changes between two fetches')
+    parser.add_argument('--window', action='store_true', help='fetch only the top entries and the window around the driver')
+    parser.add_argument('--fake-port', type=int, default=5055)
+    parser.add_argument('--port', type=int, default=5056)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    args.sessions = max(1, min(args.sessions, args.clubs))
+
+    results = run_benchmark(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
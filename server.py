@@ -1,14 +1,150 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import time
 import os
 import threading
 import logging
 import datetime
-
-# 保存JSON文件的时间间隔，单位：秒
-SAVE_INTERVAL = 1800
+import collections
+import unicodedata
+import random
+import concurrent.futures
+import hashlib
+import gzip
+import sqlite3
+import queue
+import re
+import contextlib
+import contextvars
+import functools
+import heapq
+import itertools
+import email.utils
+import operator
+import sys
+
+# numpy是可选的，没有安装时不计算计时赛的分段分析
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 各类数据在后台刷新的时间间隔，单位：秒
+REFRESH_INTERVALS = {
+    'current': 60,          # 当前赛段的俱乐部和计时赛排行榜
+    'prefetch': 300,        # 当前锦标赛所有赛段的俱乐部排行榜
+    'club_list': 3600,      # 俱乐部列表
+    'stats_values': 86400,  # 计时赛前置信息
+}
+# 多个刷新任务同时到期时，数字小的先执行；请求限速排队时也按这个顺序，SimHub请求触发的请求和'current'一样优先
+REFRESH_PRIORITIES = {
+    'current': 0,
+    'club_list': 1,
+    'stats_values': 1,
+    'prefetch': 2,
+}
+
+# Racenet API的地址，可以通过环境变量指向本地的模拟服务（见benchmark.py）
+RACENET_API_BASE = os.environ.get('RACENET_API_BASE', 'https://web-api.racenet.com/api')
+
+# HTTP请求的连接超时和读取超时，单位：秒
+HTTP_TIMEOUT = (5, 15)
+# 遇到5xx或超时时的最大重试次数，以及重试等待的基础时间，单位：秒
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_BASE = 0.5
+# 连接池大小
+HTTP_POOL_SIZE = 10
+
+# 所有Racenet API请求共用的限速：初始每秒请求数、上下限，以及可以连续发出的请求数
+RATE_LIMIT_RATE = 10
+RATE_LIMIT_MIN_RATE = 0.5
+RATE_LIMIT_MAX_RATE = 20
+RATE_LIMIT_BURST = 20
+# 每次请求成功后提高的每秒请求数；收到429时每秒请求数减半
+RATE_LIMIT_INCREASE = 0.1
+# 收到429但没有Retry-After时暂停请求的时间，单位：秒
+RATE_LIMIT_RETRY_AFTER = 10
+
+# 俱乐部排行榜每页获取的条目数，API不接受时会退回到DEFAULT_PAGE_SIZE
+CLUB_LEADERBOARD_PAGE_SIZE = 100
+DEFAULT_PAGE_SIZE = 20
+# 增量同步排行榜时，每隔这段时间做一次完整的同步，单位：秒
+LEADERBOARD_FULL_SYNC_INTERVAL = 300
+# 增量同步保留的排行榜快照的最大数量，超出后淘汰最久未使用的排行榜
+LEADERBOARD_SNAPSHOT_MAX_ENTRIES = 128
+
+# 排行榜的获取方式：'full' 俱乐部获取全部条目，计时赛获取前max_page页；'window' 只获取前N名和车手前后K名
+LEADERBOARD_FETCH_MODE = {
+    'club': 'full',
+    'time_trial': 'full',
+}
+LEADERBOARD_WINDOW_TOP = 10
+LEADERBOARD_WINDOW_AROUND = 5
+
+# 同时生成排行榜数据的最大线程数
+GENERATOR_WORKERS = 4
+
+# 收到SimHub请求后等待的时间，期间同一会话收到的请求只处理一次，单位：秒
+GENERATION_DEBOUNCE = 0.5
+# 同一会话在这段时间内已经生成过，就不再重复生成，单位：秒
+GENERATION_FRESH_INTERVAL = 15
+# 负责生成JSON数据的线程数，所有会话共用；所有会话共用输出文件时同一时间只有一个线程在生成
+SESSION_WORKERS = 2
+# 会话在这段时间内没有收到SimHub请求，就停止刷新并移除，单位：秒
+SESSION_IDLE_TIMEOUT = 300
+# 是否为每个会话单独保存JSON文件（racenet_club_<sessionID>.json）；为False时所有会话都写入racenet_club.json等文件，适合只有一台设备的情况
+SESSION_OUTPUT_FILES = False
+
+# HTTP服务的地址、端口，以及安装了waitress时的线程数（每个/stream连接占用一个线程）
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 5000
+SERVER_THREADS = 16
+
+# 从内存提供排行榜数据时，是否对大于该字节数的响应进行gzip压缩，设为None则不压缩
+SERVE_GZIP_MIN_SIZE = 1024
+
+# 推送排行榜变化时，没有变化的情况下发送心跳的时间间隔，单位：秒
+STREAM_HEARTBEAT_INTERVAL = 15
+# 每个订阅者最多积压的事件数，超出后清空并重新发送完整数据
+STREAM_QUEUE_SIZE = 100
+
+# 每次刷新的耗时记录（Chrome Trace格式，每行一次刷新），可以在chrome://tracing或Perfetto中打开，设为None则不记录
+TRACE_LOG = None  # 例如 'racenet_trace.jsonl'
+
+# 保存排行榜历史快照的SQLite数据库
+HISTORY_DB = 'racenet_history.db'
+# 历史快照保留的天数，以及每个排行榜最多保留的快照数
+HISTORY_RETENTION_DAYS = 120
+HISTORY_MAX_SNAPSHOTS_PER_BOARD = 500
+# 清理历史快照的时间间隔，单位：秒
+HISTORY_COMPACT_INTERVAL = 3600
+
+# 计时赛的路面条件：(surfaceConditionID, 名字)
+TIME_TRIAL_CONDITIONS = [(0, 'dry'), (1, 'wet')]
+# 是否为计时赛排行榜计算每个分段和第一名、自己、前车的时间差，分段排名和理论最快时间（需要安装numpy）
+TIME_TRIAL_ANALYTICS = True
+
+# 各类API响应的缓存时间，单位：秒
+CACHE_TTL = {
+    'club_meta': 60,        # 俱乐部赛事信息，没有赛事开始或结束的时间时使用
+    'leaderboard': 15,      # 俱乐部和计时赛排行榜
+    'stats_values': 3600,   # 计时赛前置信息
+}
+# 缓存的最大条目数，超出后淘汰最久未使用的条目
+CACHE_MAX_ENTRIES = 256
+
+# 检查racenet_carClasses.json是否被修改的时间间隔，单位：秒
+VEHICLE_CLASS_CHECK_INTERVAL = 5
+
+# 获取俱乐部列表时并行请求分页的线程数
+CLUB_LIST_WORKERS = 4
+# 俱乐部赛事信息缓存到下一个赛事开始或结束的时间，但最长不超过这个时间，单位：秒
+CLUB_EVENTS_MAX_TTL = 1800
+
+# 启动时先使用上次保存的个人信息、计时赛前置信息和俱乐部列表，同时在后台并行重新获取
+WARM_START = True
 
 app = Flask(__name__)
 
@@ -21,19 +157,111 @@ DEBUG = False
 # 保存access token和refresh token
 access_token = ''
 refresh_token = ''
+access_token_ready = threading.Event()
 
-# 保存SimHub传递的数据
-simhub_data = {}
+# 每个 (clubName, trackName, vehicleID) 一个会话，以及最近一次收到SimHub请求的会话
+sessions = {}
+sessions_lock = threading.Lock()
+latest_session = None
 
-# 保存从API获取的数据
+# 保存从API获取的、所有会话共用的数据
+personal_info = {}
 club_list_data = {}
-club_events_data = {}
-club_leaderboard_data = {}
 time_trial_pre_info = {}
-time_trial_leaderboard_data = {}
 
-# 保存最终生成的JSON数据
-club_json = {}
+# 个人信息、计时赛前置信息和俱乐部列表的获取时间：文件名 -> 时间戳
+pre_data_fetched_at = {}
+
+# 保护各会话最新生成的排行榜数据，以及推送的订阅者列表
+latest_payloads_lock = threading.Lock()
+
+# 运行指标：计数器和直方图，通过/metrics以Prometheus文本格式输出
+METRICS = {
+    'racenet_upstream_request_seconds': ('histogram', 'Latency of requests to the Racenet API', (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    'racenet_upstream_responses_total': ('counter', 'Responses from the Racenet API by status', None),
+    'racenet_leaderboard_pages_fetched': ('histogram', 'Leaderboard pages fetched per sync', (0, 1, 2, 5, 10, 20, 50, 100)),
+    'racenet_club_list_refresh_seconds': ('histogram', 'Time to page through the club memberships', (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    'racenet_cache_requests_total': ('counter', 'API cache lookups by result (hit, miss, shared)', None),
+    'racenet_generate_seconds': ('histogram', 'Time to fetch and write one output', (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    'racenet_output_write_seconds': ('histogram', 'Time to write an output file', (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)),
+    'racenet_rate_limit_wait_seconds': ('histogram', 'Time a request waited for the rate limiter by priority', (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    'racenet_split_analytics_seconds': ('histogram', 'Time to compute the split analytics of a time trial board', (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)),
+    'racenet_simhub_to_payload_seconds': ('histogram', 'Time from a SimHub request to fresh payloads', (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)),
+}
+metrics_values = {}
+metrics_lock = threading.Lock()
+
+# 当前这次刷新的耗时记录，TRACE_LOG为None时不记录
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+# 订阅排行榜变化推送的客户端，每个客户端一个事件队列
+stream_subscribers = []
+
+# 生成的JSON文件的内容哈希（不含lastUpdated），以及写入和跳过写入的次数
+output_hashes = {}
+output_write_stats = {'written': 0, 'skipped': 0, 'bytesWritten': 0}
+output_lock = threading.Lock()
+
+# 排行榜历史数据库的连接
+history_db = None
+history_db_lock = threading.Lock()
+history_last_compacted = 0
+# 每个排行榜最近一次保存的快照内容的哈希，多个会话看同一个排行榜时只保存一次
+history_last_rows = {}
+
+# 每个排行榜上一次同步的结果，用于增量同步
+leaderboard_snapshots = collections.OrderedDict()
+leaderboard_snapshots_lock = threading.Lock()
+# 每种排行榜接口实际接受的每页条目数，被拒绝过一次后直接使用退回的值
+leaderboard_page_sizes = {}
+
+# 请求限速的令牌桶状态，以及按 (优先级, 序号) 排队等待发出的请求
+rate_limit_state = {'rate': RATE_LIMIT_RATE, 'tokens': RATE_LIMIT_BURST, 'updated': time.time(), 'blockedUntil': 0}
+rate_limit_waiters = []
+rate_limit_sequence = itertools.count()
+rate_limit_condition = threading.Condition()
+
+# 当前线程发出的请求的优先级，后台刷新任务设置为REFRESH_PRIORITIES中对应的值
+request_priority = contextvars.ContextVar('request_priority', default=0)
+
+# 所有Racenet API请求共用的连接池
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+http_session.headers.update({'User-Agent': 'Apifox/1.0.0 (https://apifox.com)'})
+
+# 并行获取排行榜数据的线程池
+generator_pool = concurrent.futures.ThreadPoolExecutor(max_workers=GENERATOR_WORKERS, thread_name_prefix='generator')
+
+# API响应缓存，以及正在进行中的请求
+api_cache = collections.OrderedDict()
+api_cache_inflight = {}
+api_cache_lock = threading.Lock()
+
+# 车辆组别索引：vehicleID -> (vehicleClassID, 组别名字)
+vehicle_class_index = {}
+vehicle_class_index_mtime = None
+vehicle_class_index_checked = 0
+vehicle_class_index_lock = threading.Lock()
+
+# 俱乐部目录：按clubName、规范化的clubName和clubID索引的俱乐部成员信息，俱乐部列表更新时整体替换
+club_directory = {'name': {}, 'normalized': {}, 'id': {}}
+
+# 赛段名字索引：按名字长度从长到短排列的 (规范化名字, routeID, routeName)，以及trackName的匹配结果
+route_index = []
+route_match_memo = {}
+route_index_lock = threading.Lock()
+
+# 等待生成JSON数据的会话
+generation_queue = queue.Queue()
+# 所有会话共用输出文件时，同一时间只有一个会话在生成，以及文件里现在是哪个会话的数据
+shared_output_lock = threading.Lock()
+last_output_session = None
+
+# 后台刷新任务下一次执行的时间
+refresh_deadlines = {}
+refresh_condition = threading.Condition()
 
 # 开始线程
 def start_refresh_token_thread():
@@ -46,20 +274,553 @@ def start_pre_data_fetching_thread():
     data_fetching_thread.daemon = True
     data_fetching_thread.start()
 
-def start_save_json_thread():
-    save_json_thread = threading.Thread(target=save_json)
-    save_json_thread.daemon = True
-    save_json_thread.start()
+def start_refresh_scheduler_thread():
+    refresh_scheduler_thread = threading.Thread(target=refresh_scheduler)
+    refresh_scheduler_thread.daemon = True
+    refresh_scheduler_thread.start()
+
+def start_generation_worker_thread():
+    for _ in range(SESSION_WORKERS):
+        generation_worker_thread = threading.Thread(target=generation_worker)
+        generation_worker_thread.daemon = True
+        generation_worker_thread.start()
 
 def fetch_pre_data():
     # Wait for the token to be fetched
-    while not access_token:
-        time.sleep(1)  # Sleep for a short time to prevent high CPU usage
+    access_token_ready.wait()
+
+    # Now that we have the token, fetch the data in parallel; each one replaces the saved copy once it is complete
+    request_priority.set(REFRESH_PRIORITIES['club_list'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3, thread_name_prefix='pre_data') as pool:
+        tasks = [pool.submit(contextvars.copy_context().run, fetch, force_update=True) for fetch in (get_personal_info, get_time_trial_pre_info, get_club_list)]
+        for task in tasks:
+            try:
+                task.result()
+            except Exception as e:
+                print(f"An error occurred while fetching pre data: {e}")
+
+############################################################################################
+#
+# 启动数据：个人信息、计时赛前置信息和俱乐部列表保存在本地文件中，启动时直接读取，文件的修改时间就是获取时间
+#
+############################################################################################
+def load_pre_data(filename):
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Error: Could not read {filename}: {e}")
+        return None
+    pre_data_fetched_at[filename] = os.path.getmtime(filename)
+    return data
+
+def save_pre_data(filename, data):
+    # Write to a temporary file first, so a crash never leaves a half written file for the next warm start
+    temp_filename = f'{filename}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_filename, filename)
+    except OSError as e:
+        print(f"Error: Could not save {filename}: {e}")
+        return
+    finally:
+        remove_temp_file(temp_filename)
+    pre_data_fetched_at[filename] = time.time()
+
+# 写入或替换失败时留下的临时文件（Windows上Overlay打开着目标文件时os.replace会失败）
+def remove_temp_file(temp_filename):
+    try:
+        os.remove(temp_filename)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Error: Could not remove {temp_filename}: {e}")
+
+def warm_start():
+    global personal_info
+
+    data = load_pre_data('racenet_personal_info.json')
+    if data:
+        personal_info = data
+    data = load_pre_data('racenet_time_trial_pre_info.json')
+    if data:
+        set_time_trial_pre_info(data)
+    data = load_pre_data('racenet_club_list_data.json')
+    if data:
+        set_club_list_data(data)
+
+    for filename, fetched_at in pre_data_fetched_at.items():
+        print(f"Warm start: {filename} fetched at {datetime.datetime.fromtimestamp(fetched_at).strftime('%Y-%m-%d %H:%M:%S')}")
+
+############################################################################################
+#
+# 运行指标：记录各个环节的耗时和次数，/metrics路由以Prometheus文本格式输出
+#
+############################################################################################
+def inc_counter(name, value=1, **labels):
+    key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+    with metrics_lock:
+        metrics_values[key] = metrics_values.get(key, 0) + value
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+    buckets = METRICS[name][2]
+    with metrics_lock:
+        histogram = metrics_values.get(key)
+        if histogram is None:
+            histogram = metrics_values[key] = {'buckets': [0] * len(buckets), 'sum': 0, 'count': 0}
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+@contextlib.contextmanager
+def timed(name, **labels):
+    started = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - started
+        observe(name, duration, **labels)
+        # Also add a span to the trace of the current refresh
+        trace = current_trace.get()
+        if trace is not None:
+            trace['traceEvents'].append({'name': name, 'cat': 'racenet', 'ph': 'X', 'ts': int(started * 1e6), 'dur': int(duration * 1e6), 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': labels})
+
+def write_trace(trace):
+    try:
+        with open(TRACE_LOG, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(trace, ensure_ascii=False) + '\n')
+    except OSError as e:
+        print(f"An error occurred while writing the trace log: {e}")
+
+# 把路径中的ID替换掉，避免每个俱乐部和排行榜都变成单独的指标
+def endpoint_label(path):
+    return '/'.join('{id}' if re.fullmatch(r'\d+|[0-9a-fA-F-]{16,}', segment) else segment for segment in path.split('/'))
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+def render_metrics():
+    with metrics_lock:
+        values = {key: (dict(value, buckets=list(value['buckets'])) if isinstance(value, dict) else value) for key, value in metrics_values.items()}
+
+    lines = []
+    for name, (metric_type, description, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for (metric_name, labels), value in sorted(values.items()):
+            if metric_name != name:
+                continue
+            labels = dict(labels)
+            if metric_type == 'counter':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+            for bound, count in zip(buckets, value['buckets']):
+                lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {count}')
+            lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {value["count"]}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value["sum"]}')
+            lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+
+    # Gauges are read when scraped
+    with output_lock:
+        output_stats = dict(output_write_stats)
+    with rate_limit_condition:
+        refill_rate_limit_tokens(time.time())
+        rate_state = dict(rate_limit_state)
+        rate_waiters = list(rate_limit_waiters)
+    gauges = [
+        ('racenet_output_writes_total', 'counter', 'Output file writes by result', [({'result': 'written'}, output_stats['written']), ({'result': 'skipped'}, output_stats['skipped'])]),
+        ('racenet_output_bytes_written_total', 'counter', 'Bytes written to output files', [({}, output_stats['bytesWritten'])]),
+        ('racenet_generation_pending', 'gauge', 'Sessions waiting for a generation worker', [({}, generation_queue.qsize())]),
+        ('racenet_sessions', 'gauge', 'Active SimHub sessions', [({}, len(sessions))]),
+        ('racenet_refresh_tasks_due', 'gauge', 'Background refresh tasks past their deadline', [({}, sum(deadline <= time.time() for deadline in list(refresh_deadlines.values())))]),
+        ('racenet_api_cache_entries', 'gauge', 'Entries in the API response cache', [({}, len(api_cache))]),
+        ('racenet_stream_subscribers', 'gauge', 'Connected /stream clients', [({}, len(stream_subscribers))]),
+        ('racenet_rate_limit_rate', 'gauge', 'Requests per second currently allowed to the Racenet API', [({}, round(rate_state['rate'], 3))]),
+        ('racenet_rate_limit_tokens', 'gauge', 'Requests that can be sent right away', [({}, round(rate_state['tokens'], 3))]),
+        ('racenet_rate_limit_blocked_seconds', 'gauge', 'Time left before requests resume after a 429', [({}, round(max(0, rate_state['blockedUntil'] - time.time()), 3))]),
+        ('racenet_rate_limit_waiting', 'gauge', 'Requests waiting for the rate limiter by priority', [({'priority': priority}, count) for priority, count in sorted(collections.Counter(priority for priority, _ in rate_waiters).items())]),
+        ('racenet_pre_data_age_seconds', 'gauge', 'Age of the personal info, time trial pre-info and club list', [({'file': filename}, round(time.time() - fetched_at, 3)) for filename, fetched_at in list(pre_data_fetched_at.items())]),
+    ]
+    for name, metric_type, description, samples in gauges:
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        lines.extend(f'{name}{format_labels(labels)} {value}' for labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+############################################################################################
+#
+# HTTP请求：复用连接，设置超时，遇到5xx或超时时退避重试
+#
+############################################################################################
+def racenet_request(method, path, params=None, headers=None, auth=True, **kwargs):
+    url = f"{RACENET_API_BASE}{path}"
+    request_headers = {'Authorization': f'Bearer {access_token}'} if auth else {}
+    if headers:
+        request_headers.update(headers)
+    # Only idempotent requests are retried
+    max_retries = HTTP_MAX_RETRIES if method == 'GET' else 0
+
+    endpoint = endpoint_label(path)
+    priority = request_priority.get()
+
+    for attempt in range(max_retries + 1):
+        acquire_request_slot(priority)
+        try:
+            with timed('racenet_upstream_request_seconds', endpoint=endpoint):
+                response = http_session.request(method, url, params=params, headers=request_headers, timeout=HTTP_TIMEOUT, **kwargs)
+            inc_counter('racenet_upstream_responses_total', endpoint=endpoint, status=str(response.status_code))
+            record_rate_limit_response(response)
+            # The rate limiter holds the next attempt until Retry-After has passed
+            if response.status_code == 429 and attempt < max_retries:
+                if DEBUG:
+                    logging.debug(f"{method} {path} was throttled, retrying")
+                continue
+            if response.status_code < 500 or attempt == max_retries:
+                return response
+            if DEBUG:
+                logging.debug(f"{method} {path} returned {response.status_code}, retrying")
+        except (requests.Timeout, requests.ConnectionError) as e:
+            inc_counter('racenet_upstream_responses_total', endpoint=endpoint, status='timeout' if isinstance(e, requests.Timeout) else 'connection_error')
+            if attempt == max_retries:
+                raise
+            if DEBUG:
+                logging.debug(f"{method} {path} failed: {e}, retrying")
+        # Exponential backoff with jitter
+        time.sleep(HTTP_BACKOFF_BASE * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+############################################################################################
+#
+# 请求限速：令牌桶控制发往Racenet的请求速度，收到429时减半并暂停到Retry-After之后，
+# 之后每次成功慢慢提高；排队的请求按优先级发出，SimHub请求不会被后台刷新堵住
+#
+############################################################################################
+def refill_rate_limit_tokens(now):
+    # Called with rate_limit_condition held, no tokens build up while paused after a 429
+    elapsed = max(0, now - max(rate_limit_state['updated'], rate_limit_state['blockedUntil']))
+    rate_limit_state['tokens'] = min(RATE_LIMIT_BURST, rate_limit_state['tokens'] + elapsed * rate_limit_state['rate'])
+    rate_limit_state['updated'] = now
+
+def acquire_request_slot(priority):
+    started = time.time()
+    with rate_limit_condition:
+        waiter = (priority, next(rate_limit_sequence))
+        heapq.heappush(rate_limit_waiters, waiter)
+        while True:
+            now = time.time()
+            refill_rate_limit_tokens(now)
+            # Only the first request in line waits for a token, the others wait for their turn
+            if rate_limit_waiters[0] != waiter:
+                timeout = None
+            elif now < rate_limit_state['blockedUntil']:
+                timeout = rate_limit_state['blockedUntil'] - now
+            elif rate_limit_state['tokens'] < 1:
+                timeout = (1 - rate_limit_state['tokens']) / rate_limit_state['rate']
+            else:
+                break
+            rate_limit_condition.wait(timeout)
+        heapq.heappop(rate_limit_waiters)
+        rate_limit_state['tokens'] -= 1
+        rate_limit_condition.notify_all()
+    observe('racenet_rate_limit_wait_seconds', time.time() - started, priority=priority)
+
+def record_rate_limit_response(response):
+    with rate_limit_condition:
+        now = time.time()
+        if response.status_code == 429:
+            # Requests already in flight get throttled too, only slow down once per pause
+            if now >= rate_limit_state['blockedUntil']:
+                refill_rate_limit_tokens(now)
+                rate_limit_state['rate'] = max(RATE_LIMIT_MIN_RATE, rate_limit_state['rate'] / 2)
+                rate_limit_state['tokens'] = 0
+            rate_limit_state['blockedUntil'] = max(rate_limit_state['blockedUntil'], now + parse_retry_after(response.headers.get('Retry-After')))
+            rate_limit_condition.notify_all()
+        elif response.status_code < 500:
+            refill_rate_limit_tokens(now)
+            rate_limit_state['rate'] = min(RATE_LIMIT_MAX_RATE, rate_limit_state['rate'] + RATE_LIMIT_INCREASE)
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return RATE_LIMIT_RETRY_AFTER
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return RATE_LIMIT_RETRY_AFTER
+
+def racenet_get(path, params=None, **kwargs):
+    return racenet_request('GET', path, params=params, **kwargs)
+
+def racenet_post(path, **kwargs):
+    return racenet_request('POST', path, **kwargs)
+
+############################################################################################
+#
+# API响应缓存：按接口类型和参数缓存结果，相同的请求同一时间只发出一次
+#
+############################################################################################
+def cached_api_call(kind, key, fetch, force_update=False, ttl=None):
+    cache_key = (kind, key)
+    with api_cache_lock:
+        if not force_update:
+            cached = api_cache.get(cache_key)
+            if cached and cached[0] > time.time():
+                api_cache.move_to_end(cache_key)
+                inc_counter('racenet_cache_requests_total', kind=kind, result='hit')
+                return cached[1]
+        inflight = api_cache_inflight.get(cache_key)
+        is_leader = inflight is None
+        if is_leader:
+            inflight = {'event': threading.Event(), 'value': None}
+            api_cache_inflight[cache_key] = inflight
+    inc_counter('racenet_cache_requests_total', kind=kind, result='miss' if is_leader else 'shared')
+
+    # Another thread is already fetching this key, wait for its result
+    if not is_leader:
+        inflight['event'].wait()
+        return inflight['value']
+
+    value = None
+    try:
+        value = fetch()
+    finally:
+        with api_cache_lock:
+            # Failed requests return None and are not cached
+            if value is not None:
+                api_cache[cache_key] = (time.time() + (ttl(value) if ttl else CACHE_TTL[kind]), value)
+                api_cache.move_to_end(cache_key)
+                while len(api_cache) > CACHE_MAX_ENTRIES:
+                    api_cache.popitem(last=False)
+            del api_cache_inflight[cache_key]
+        inflight['value'] = value
+        inflight['event'].set()
+    return value
+
+############################################################################################
+#
+# 排行榜条目：API返回的条目只解析一次，保存为只有输出用到的字段的LeaderboardEntry，原始数据随即丢弃；
+# 缓存、增量同步的快照和生成的数据共用这些对象，每份输出用LeaderboardTable选择要写出的字段，再加上自己的列
+#
+############################################################################################
+class LeaderboardEntry:
+    __slots__ = ('rank', 'displayName', 'time', 'differenceToFirst', 'nationalityID', 'timePenalty', 'vehicle', 'points', 'splits', 'rankGap')
+
+    def __init__(self, data):
+        for field in self.__slots__:
+            setattr(self, field, data.get(field))
+        # Most drivers share the same car and penalty, keep one copy of each string
+        if type(self.vehicle) is str:
+            self.vehicle = sys.intern(self.vehicle)
+        if type(self.timePenalty) is str:
+            self.timePenalty = sys.intern(self.timePenalty)
+        if self.splits is not None:
+            self.splits = tuple(self.splits)
+
+    def __eq__(self, other):
+        return isinstance(other, LeaderboardEntry) and all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __repr__(self):
+        return f'LeaderboardEntry({self.rank}, {self.displayName!r}, {self.time!r})'
+
+def fields_getter(fields):
+    # attrgetter returns a bare value for a single field, always return a tuple
+    if not fields:
+        return lambda entry: ()
+    if len(fields) == 1:
+        getter = operator.attrgetter(fields[0])
+        return lambda entry: (getter(entry),)
+    return operator.attrgetter(*fields)
+
+class LeaderboardTable:
+    __slots__ = ('entries', 'fields', 'columns')
+
+    def __init__(self, entries, fields, columns=None):
+        self.entries = entries
+        self.fields = tuple(fields)
+        # Extra values of this output only, one list per column with a value for each entry
+        self.columns = columns if columns is not None else {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def names(self):
+        return self.fields + tuple(self.columns)
+
+    def rows(self):
+        get_fields = fields_getter(self.fields)
+        columns = list(self.columns.values())
+        for index, entry in enumerate(self.entries):
+            yield get_fields(entry) + tuple(column[index] for column in columns)
+
+    def project(self, top=None, fields=None):
+        entries = self.entries[:top] if top is not None else self.entries
+        columns = {name: values[:len(entries)] for name, values in self.columns.items()}
+        if not fields:
+            return LeaderboardTable(entries, self.fields, columns)
+        return LeaderboardTable(entries, [field for field in fields if field in self.fields], {field: columns[field] for field in fields if field in columns})
+
+    def iter_json(self):
+        names = self.names()
+        if not names:
+            yield '[' + ', '.join('{}' for _ in self.entries) + ']'
+            return
+        # Encode column by column, then fill one template per entry
+        # Braces in the names are escaped, each {} is filled with one encoded value
+        template = '{{' + ', '.join(encode_json_string(name).replace('{', '{{').replace('}', '}}') + ': {}' for name in names) + '}}'
+        columns = [encode_json_column(map(operator.attrgetter(field), self.entries)) for field in self.fields]
+        columns += [encode_json_column(values) for values in self.columns.values()]
+        yield '[' + ', '.join(map(template.format, *columns)) + ']'
+
+############################################################################################
+#
+# 排行榜增量同步：从第一页开始获取，直到某一页和上一次同步的结果相同，剩下的部分沿用上一次的结果；
+# 总条目数有变化，或者还没有获取到车手自己上一次所在的位置时继续获取
+#
+############################################################################################
+def sync_leaderboard(snapshot_key, path, params, cursor_param, page_size_param, page_size, max_page=None):
+    with leaderboard_snapshots_lock:
+        snapshot = leaderboard_snapshots.get(snapshot_key)
+        if snapshot is not None:
+            leaderboard_snapshots.move_to_end(snapshot_key)
+    page_size = leaderboard_page_sizes.get(snapshot_key[0], page_size)
+    incremental = snapshot is not None and time.time() - snapshot['fullSynced'] < LEADERBOARD_FULL_SYNC_INTERVAL
+    # The driver's own row must always be fresh, so the tail is only trusted once the sync has passed it
+    my_name = get_display_name() if incremental else None
+    my_index = next((index for index, entry in enumerate(snapshot['entries']) if entry.displayName == my_name), -1) if incremental else -1
+
+    entries = []
+    total_entry_count = None
+    page_size_rejected = False
+    cursor = None
+    pages_fetched = 0
+    matched = False
+    failed = False
+
+    while True:
+        page_params = dict(params, **{page_size_param: page_size})
+        if cursor:
+            page_params[cursor_param] = cursor
+        try:
+            response = racenet_get(path, page_params)
+            if response.status_code == 400 and page_size > DEFAULT_PAGE_SIZE and not entries:
+                # The API doesn't accept this page size, fall back to the default one
+                print(f"Warning: page size {page_size} rejected, using {DEFAULT_PAGE_SIZE}")
+                page_size = DEFAULT_PAGE_SIZE
+                page_size_rejected = True
+                continue
+            if response.status_code != 200:
+                print(f"Error: {response.status_code}")
+                failed = True
+                break
+            data = response.json()
+            # Other 400s (e.g. an unknown leaderboard) fail at the default size too, only remember the size once it worked
+            if page_size_rejected:
+                leaderboard_page_sizes[snapshot_key[0]] = page_size
+                page_size_rejected = False
+        except Exception as e:
+            print(f"An error occurred while getting leaderboard data: {e}")
+            failed = True
+            break
+
+        # Keep only the parsed entries and the cursor, the raw page is dropped here
+        page = [LeaderboardEntry(entry) for entry in data['entries']]
+        next_cursor = data.get('next')  # Assuming 'nextCursor' is the key for the next cursor
+        total_entry_count = data.get('totalEntryCount')
+        del data
+        # Nothing changed from here on, reuse the rest of the snapshot; a new driver changes the count,
+        # and an improvement by the driver only shows up in the pages above their old row
+        if (incremental and page and page == snapshot['entries'][len(entries):len(entries) + len(page)]
+                and total_entry_count == snapshot['totalEntryCount'] and len(entries) + len(page) > my_index):
+            matched = True
+            break
+
+        entries.extend(page)
+        pages_fetched += 1
+        cursor = next_cursor
+        if not cursor or not page or (max_page and pages_fetched >= max_page):
+            break
+
+    observe('racenet_leaderboard_pages_fetched', pages_fetched, board=snapshot_key[0])
+    if DEBUG:
+        logging.debug(f"Leaderboard {snapshot_key} synced: {pages_fetched} pages fetched, incremental: {incremental}, matched: {matched}, failed: {failed}")
+
+    # A partly fetched board is not cached or written, the snapshot stays as it was for the next sync
+    if failed:
+        return None
+
+    if matched:
+        # Merge the fetched pages with the unchanged tail, drivers who moved up are already in the fetched pages
+        fetched_names = {entry.displayName for entry in entries}
+        entries = entries + [entry for entry in snapshot['entries'][len(entries):] if entry.displayName not in fetched_names]
+
+    full_synced = snapshot['fullSynced'] if matched else time.time()
+    with leaderboard_snapshots_lock:
+        leaderboard_snapshots[snapshot_key] = {'entries': entries, 'fullSynced': full_synced, 'totalEntryCount': total_entry_count}
+        leaderboard_snapshots.move_to_end(snapshot_key)
+        while len(leaderboard_snapshots) > LEADERBOARD_SNAPSHOT_MAX_ENTRIES:
+            leaderboard_snapshots.popitem(last=False)
+
+    return {'entries': entries}
+
+############################################################################################
+#
+# 排行榜窗口模式：只请求前N名和以车手为中心的一页（focusOnMe），合并后用rankGap标记中间跳过的名次
+#
+############################################################################################
+def fetch_leaderboard_window(path, params, page_size_param, focus_param):
+    my_name = get_display_name()
+    pages = []
+    for page_params in [
+        dict(params, **{page_size_param: LEADERBOARD_WINDOW_TOP, focus_param: 'false'}),
+        dict(params, **{page_size_param: LEADERBOARD_WINDOW_AROUND * 2 + 1, focus_param: 'true'})
+    ]:
+        try:
+            response = racenet_get(path, page_params)
+            if response.status_code == 200:
+                pages.append([LeaderboardEntry(entry) for entry in response.json()['entries']])
+                continue
+            print(f"Error: {response.status_code}")
+        except Exception as e:
+            print(f"An error occurred while getting leaderboard data: {e}")
+        pages.append(None)
 
-    # Now that we have the token, we can fetch the data
-    get_personal_info(force_update=True)
-    get_time_trial_pre_info(force_update=True)
-    get_club_list(force_update=True)
+    top_entries, around_entries = pages
+    if top_entries is None:
+        return None
+
+    entries = {entry.rank: entry for entry in top_entries}
+    # Without an entry for the driver, focusOnMe doesn't point anywhere useful
+    if around_entries and any(entry.displayName == my_name for entry in around_entries):
+        # Keep only the window around the driver, the API may return a larger page
+        my_index = next(i for i, entry in enumerate(around_entries) if entry.displayName == my_name)
+        for entry in around_entries[max(0, my_index - LEADERBOARD_WINDOW_AROUND):my_index + LEADERBOARD_WINDOW_AROUND + 1]:
+            entries.setdefault(entry.rank, entry)
+
+    # The entries were parsed for this fetch only, so rankGap can be set in place
+    merged = []
+    previous_rank = 0
+    for rank in sorted(entries):
+        entries[rank].rankGap = rank - previous_rank - 1
+        merged.append(entries[rank])
+        previous_rank = rank
+    return {'entries': merged}
 
 ############################################################################################
 #
@@ -69,11 +830,9 @@ def fetch_pre_data():
 def do_refresh_token():
     global access_token, refresh_token
     # 这里填写你的API信息
-    url = "https://web-api.racenet.com/api/identity/refresh-auth"
     headers = {
         'Content-Type': 'application/json',
         'Cookie': f'RACENET-REFRESH-TOKEN={refresh_token}',
-        'User-Agent': 'Apifox/1.0.0 (https://apifox.com)',
         'charset':'utf-8'
     }
     data = {
@@ -81,11 +840,12 @@ def do_refresh_token():
         "grantType": "refresh_token",
         "redirectUri": "https://racenet.com/oauthCallback"
     }
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = racenet_post('/identity/refresh-auth', headers=headers, data=json.dumps(data), auth=False)
     if response.status_code == 200:
         result = response.json()
         access_token = result['access_token']
         refresh_token = result['refresh_token']
+        access_token_ready.set()
         # 将新的refresh_token保存到本地文件
         with open('refresh_token.txt', 'w') as f:
             f.write(refresh_token)
@@ -106,50 +866,411 @@ def do_refresh_token():
 ############################################################################################
 @app.route('/get_simhub_data/clubName=<clubName>&trackName=<trackName>&vehicleID=<vehicleID>', methods=['GET'])
 def get_simhub_data(clubName, trackName, vehicleID):
-    global simhub_data
-    simhub_data = {
-        'clubName': clubName,
-        'trackName': trackName,
-        'vehicleID': vehicleID
-    }
+    session, created = get_session(clubName, trackName, vehicleID)
     if DEBUG:
-        logging.debug(f"Simhub data received: {simhub_data}")
-    
-    # Start a new thread to generate the JSON data
-    thread = threading.Thread(target=generate_json_data)
-    thread.daemon = True
-    thread.start()
+        logging.debug(f"Simhub data received: {session.data}, session: {session.session_id}")
+
+    # Prefetch the rest of the championship for a club no other session follows yet,
+    # once the first generation is done so the prefetch doesn't hold requests the current stage needs
+    if created and not any(other is not session and other.data['clubName'] == clubName for other in active_sessions()):
+        session.prefetch_after_generation = True
+
+    # Hand the session to the generation workers
+    session.request_generation()
 
-    return jsonify({'data received': simhub_data}), 200
+    return jsonify({'data received': session.data, 'session': session.session_id}), 200
+
+############################################################################################
+#
+# 会话：每个 (clubName, trackName, vehicleID) 有自己的待生成状态、最新的排行榜数据和输出文件，
+# HTTP连接池、缓存和排行榜快照由所有会话共用
+#
+############################################################################################
+class Session:
+    def __init__(self, club_name, track_name, vehicle_id):
+        self.data = {
+            'clubName': club_name,
+            'trackName': track_name,
+            'vehicleID': vehicle_id
+        }
+        self.session_id = hashlib.sha1('\n'.join((club_name, track_name, vehicle_id)).encode('utf-8')).hexdigest()[:10]
+        # 最新生成的排行榜数据：'club', 'time_trial_dry', 'time_trial_wet'
+        self.payloads = {}
+        # 最新数据的内容哈希（不含lastUpdated），内容变化时才更新和推送
+        self.payload_digests = {}
+        self.pending = False
+        self.requested_at = None
+        self.last_generated = 0
+        self.last_seen = time.time()
+        # 新会话第一次生成数据之后再预先获取锦标赛其他赛段，避免预取占用当前赛段的请求
+        self.prefetch_after_generation = False
+        self.lock = threading.Lock()
+
+    def request_generation(self):
+        with self.lock:
+            if self.pending:
+                return
+            self.pending = True
+            self.requested_at = time.time()
+        generation_queue.put(self)
+
+    def output_filename(self, name):
+        if SESSION_OUTPUT_FILES:
+            return f'racenet_{name}_{self.session_id}.json'
+        return f'racenet_{name}.json'
+
+def get_session(club_name, track_name, vehicle_id):
+    global latest_session
+    key = (club_name, track_name, vehicle_id)
+    with sessions_lock:
+        session = sessions.get(key)
+        created = session is None
+        if created:
+            session = sessions[key] = Session(club_name, track_name, vehicle_id)
+        # Only SimHub requests keep a session alive, the periodic refresh doesn't
+        session.last_seen = time.time()
+        latest_session = session
+    return session, created
+
+def active_sessions():
+    with sessions_lock:
+        return list(sessions.values())
+
+def find_session(session_id):
+    return next((session for session in active_sessions() if session.session_id == session_id), None)
+
+# 移除长时间没有收到SimHub请求的会话
+def expire_sessions():
+    global latest_session
+    with sessions_lock:
+        for key, session in list(sessions.items()):
+            if time.time() - session.last_seen > SESSION_IDLE_TIMEOUT:
+                del sessions[key]
+                if latest_session is session:
+                    latest_session = None
+                if DEBUG:
+                    logging.debug(f"Session expired: {session.data}")
+
+# 生成JSON数据的工作线程，同一会话在等待期间收到的请求只处理一次；
+# 所有会话共用输出文件时只生成最近的会话，并且一个接一个地生成，旧的会话不会覆盖新会话的文件
+def generation_worker():
+    global last_output_session
+    while True:
+        session = generation_queue.get()
+
+        # Let a burst of requests settle before fetching
+        time.sleep(max(0, session.requested_at + GENERATION_DEBOUNCE - time.time()))
+        with session.lock:
+            session.pending = False
+            requested_at = session.requested_at
+
+        if SESSION_OUTPUT_FILES:
+            if time.time() - session.last_generated < GENERATION_FRESH_INTERVAL:
+                if DEBUG:
+                    logging.debug(f"Skip generation, data is still fresh: {session.data}")
+                continue
+            generate_session(session, requested_at)
+            continue
+
+        with shared_output_lock:
+            if session is not latest_session:
+                if DEBUG:
+                    logging.debug(f"Skip generation, a newer session owns the output files: {session.data}")
+                continue
+            # The data is only fresh if the shared files still hold this session's boards
+            if last_output_session is session and time.time() - session.last_generated < GENERATION_FRESH_INTERVAL:
+                if DEBUG:
+                    logging.debug(f"Skip generation, data is still fresh: {session.data}")
+                continue
+            generate_session(session, requested_at)
+            last_output_session = session
+
+def generate_session(session, requested_at):
+    try:
+        generate_json_data(session)
+    except Exception as e:
+        print(f"An error occurred while generating JSON data: {e}")
+    observe('racenet_simhub_to_payload_seconds', time.time() - requested_at)
+    session.last_generated = time.time()
+    if session.prefetch_after_generation:
+        session.prefetch_after_generation = False
+        schedule_refresh('prefetch')
+
+############################################################################################
+#
+# 从内存提供最新的排行榜数据，支持ETag/304、gzip压缩，以及top（前N名）和fields（只返回指定字段）参数
+#
+############################################################################################
+# 会话自己的数据有变化时更新并推送，和输出文件是否写入无关（多个会话可能共用同一个文件）
+def set_latest_payload(session, name, payload, digest):
+    with latest_payloads_lock:
+        if session.payload_digests.get(name) == digest:
+            return False
+        previous = session.payloads.get(name)
+        session.payloads[name] = payload
+        session.payload_digests[name] = digest
+        publish_payload_change(session, name, previous, payload)
+    return True
+
+# 根据请求参数找到会话：session=<sessionID>，或者clubName、trackName和vehicleID；都没有时使用最近一次收到SimHub请求的会话
+def session_from_request():
+    if 'session' in request.args:
+        return find_session(request.args['session'])
+    if 'clubName' in request.args:
+        with sessions_lock:
+            return sessions.get((request.args['clubName'], request.args.get('trackName', ''), request.args.get('vehicleID', '')))
+    return latest_session
+
+def project_payload(payload, top=None, fields=None):
+    entries = payload.get('leaderboardEntries')
+    if entries is None or (top is None and not fields):
+        return payload
+    return dict(payload, leaderboardEntries=entries.project(top, fields))
+
+def serve_payload(name):
+    session = session_from_request()
+    with latest_payloads_lock:
+        payload = session.payloads.get(name) if session else None
+    if payload is None:
+        return jsonify({'error': 'No data yet'}), 404
+
+    top = request.args.get('top', type=int)
+    # A negative top would slice from the end of the board
+    if top is not None and top < 0:
+        return jsonify({'error': 'top must be 0 or more'}), 400
+    fields = [field for field in request.args.get('fields', '').split(',') if field]
+    body = encode_json(project_payload(payload, top, fields)).encode('utf-8')
+
+    use_gzip = SERVE_GZIP_MIN_SIZE is not None and len(body) >= SERVE_GZIP_MIN_SIZE and 'gzip' in request.headers.get('Accept-Encoding', '')
+    etag = hashlib.sha1(body).hexdigest() + ('-gzip' if use_gzip else '')
+
+    # The overlay already has this version
+    if_none_match = [tag.strip().removeprefix('W/').strip('"') for tag in request.headers.get('If-None-Match', '').split(',')]
+    if etag in if_none_match or '*' in if_none_match:
+        response = Response(status=304)
+    else:
+        if use_gzip:
+            body = gzip.compress(body, compresslevel=5)
+        response = Response(body, mimetype='application/json')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.headers['ETag'] = f'"{etag}"'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/overlay/club', methods=['GET'])
+def get_overlay_club():
+    return serve_payload('club')
+
+@app.route('/overlay/time_trial/<condition>', methods=['GET'])
+def get_overlay_time_trial(condition):
+    if condition not in [name for _, name in TIME_TRIAL_CONDITIONS]:
+        return jsonify({'error': f'Unknown condition: {condition}'}), 404
+    return serve_payload(f'time_trial_{condition}')
+
+############################################################################################
+#
+# 通过Server-Sent Events推送排行榜变化：连接时先发送完整数据，之后只发送变化的部分
+#
+############################################################################################
+def diff_payloads(previous, payload):
+    # A different stage, club or car is a new leaderboard, not a diff; the other keys are sent along with the diff
+    updated_keys = ('lastUpdated', 'theoreticalBestSplits', 'theoreticalBestTime')
+    ignored_keys = updated_keys + ('leaderboardEntries',)
+    if previous is None or {key: value for key, value in previous.items() if key not in ignored_keys} != {key: value for key, value in payload.items() if key not in ignored_keys}:
+        return None
+    names = payload['leaderboardEntries'].names()
+    if previous['leaderboardEntries'].names() != names:
+        return None
+
+    # Compare value tuples, dicts are only built for the entries that are sent
+    old_rows = {entry.displayName: row for entry, row in zip(previous['leaderboardEntries'].entries, previous['leaderboardEntries'].rows())}
+    new_rows = {entry.displayName: row for entry, row in zip(payload['leaderboardEntries'].entries, payload['leaderboardEntries'].rows())}
+    changed = []
+    for name, row in new_rows.items():
+        old_row = old_rows.get(name)
+        if old_row is not None and old_row != row:
+            changed.append(dict({key: value for key, value, old_value in zip(names, row, old_row) if old_value != value}, displayName=name))
+    return {
+        'added': [dict(zip(names, row)) for name, row in new_rows.items() if name not in old_rows],
+        'removed': [name for name in old_rows if name not in new_rows],
+        'changed': changed,
+        **{key: payload[key] for key in updated_keys if key in payload}
+    }
+
+# 需要在持有latest_payloads_lock时调用，保证新订阅者不会漏掉或重复收到变化
+def publish_payload_change(session, name, previous, payload):
+    diff = diff_payloads(previous, payload)
+    event = ('snapshot', {'session': session.session_id, 'name': name, 'payload': payload}) if diff is None else ('diff', dict(diff, session=session.session_id, name=name))
+    for subscriber in stream_subscribers:
+        try:
+            subscriber.put_nowait(event)
+        except queue.Full:
+            # The client fell behind, drop its backlog and send it everything again
+            # The stream thread may take the last event between empty() and get_nowait()
+            try:
+                while True:
+                    subscriber.get_nowait()
+            except queue.Empty:
+                pass
+            subscriber.put_nowait(('resync', None))
+
+def format_stream_event(event, data):
+    return f"event: {event}\ndata: {encode_json(data)}\n\n"
+
+@app.route('/stream', methods=['GET'])
+def get_stream():
+    names = [name for name in request.args.get('payloads', '').split(',') if name]
+    # Follow one session, or all of them when none is given
+    session_id = request.args.get('session')
+    subscriber = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    def wanted(data):
+        return (not names or data['name'] in names) and (session_id is None or data['session'] == session_id)
+
+    def snapshot_events():
+        with latest_payloads_lock:
+            snapshots = [{'session': session.session_id, 'name': name, 'payload': payload} for session in active_sessions() for name, payload in session.payloads.items()]
+        return [format_stream_event('snapshot', data) for data in snapshots if wanted(data)]
+
+    def generate():
+        yield from snapshot_events()
+        while True:
+            try:
+                event, data = subscriber.get(timeout=STREAM_HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+            if event == 'resync':
+                yield from snapshot_events()
+            elif wanted(data):
+                yield format_stream_event(event, data)
+
+    def unsubscribe():
+        with latest_payloads_lock:
+            if subscriber in stream_subscribers:
+                stream_subscribers.remove(subscriber)
+
+    # Subscribe before the snapshot is taken, so no change falls in between
+    with latest_payloads_lock:
+        stream_subscribers.append(subscriber)
+    response = Response(generate(), mimetype='text/event-stream')
+    response.call_on_close(unsubscribe)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# 先解析一次公共的输入（车手名字、车辆组别、赛段），再并行获取计时赛（干地、湿地）和俱乐部的排行榜
+def generate_json_data(session):
+    trace = {'traceEvents': [], 'session': session.session_id, 'simhubData': session.data} if TRACE_LOG else None
+    trace_token = current_trace.set(trace)
+
+    try:
+        with timed('racenet_generate_seconds', output='all'):
+            inputs = resolve_simhub_inputs(session.data)
+
+            # Each task runs in a copy of this context, so its timings land in the same trace
+            tasks = [generator_pool.submit(contextvars.copy_context().run, timed_generate, f'time_trial_{condition}', generate_time_trial_condition_json, session, inputs, surface_condition_id, condition) for surface_condition_id, condition in TIME_TRIAL_CONDITIONS]
+            tasks.append(generator_pool.submit(contextvars.copy_context().run, timed_generate, 'club', generate_club_json, session, inputs))
+
+            for task in concurrent.futures.as_completed(tasks):
+                try:
+                    task.result()
+                except Exception as e:
+                    print(f"An error occurred while generating JSON data: {e}")
+    finally:
+        current_trace.reset(trace_token)
+
+    if trace is not None:
+        write_trace(trace)
+
+def timed_generate(output, generate, *args):
+    with timed('racenet_generate_seconds', output=output):
+        generate(*args)
+
+def resolve_simhub_inputs(data):
+    vehicle_class_id, vehicle_class_name = get_vehicle_classes_info(data['vehicleID'])
+    stage_id, stage_name = get_stage_info(data['trackName'])
+    return {
+        'clubName': data['clubName'],
+        'myName': get_display_name(),
+        'vehicleClassID': vehicle_class_id,
+        'vehicleClassName': vehicle_class_name,
+        'stageID': stage_id,
+        'stageName': stage_name
+    }
 
-def generate_json_data():
-    generate_time_trial_json()
-    generate_club_json()
-    
-    
 
 ############################################################################################
 #
 # 从本地的racenet_carClasses.json文件中获取信息，创建函数，从输入的vehicleID获取到vehicleClassesID和组别名字
 #
 ############################################################################################
+def load_vehicle_class_index():
+    global vehicle_class_index, vehicle_class_index_mtime, vehicle_class_index_checked
+
+    # Only stat the file every few seconds, the index is rebuilt when its mtime changes
+    if vehicle_class_index_mtime is not None and time.time() - vehicle_class_index_checked < VEHICLE_CLASS_CHECK_INTERVAL:
+        return vehicle_class_index
+
+    with vehicle_class_index_lock:
+        vehicle_class_index_checked = time.time()
+        mtime = os.path.getmtime('racenet_carClasses.json')
+        if mtime == vehicle_class_index_mtime:
+            return vehicle_class_index
+
+        with open('racenet_carClasses.json', 'r', encoding='utf-8') as f:
+            car_classes = json.load(f)
+        index = {}
+        for vehicle_class_id, vehicle_class in car_classes['vehicleClasses'].items():
+            for vehicle_id in vehicle_class['cars']:
+                # Keep the first class a vehicle appears in
+                index.setdefault(vehicle_id, (vehicle_class_id, vehicle_class['class']))
+        vehicle_class_index = index
+        vehicle_class_index_mtime = mtime
+        if DEBUG:
+            logging.debug(f"Vehicle class index loaded: {len(index)} vehicles")
+
+    return vehicle_class_index
+
 def get_vehicle_classes_info(vehicle_id):
-    with open('racenet_carClasses.json', 'r', encoding='utf-8') as f:
-        car_classes = json.load(f)
-    for vehicle_class_id, vehicle_class in car_classes['vehicleClasses'].items():
-        if vehicle_id in vehicle_class['cars']:
-            return vehicle_class_id, vehicle_class['class']
-    return None, None
+    return load_vehicle_class_index().get(str(vehicle_id), (None, None))
+
+# 批量查询多个vehicleID的组别信息，返回 {vehicleID: (vehicleClassID, 组别名字)}
+def get_vehicle_classes_info_bulk(vehicle_ids):
+    index = load_vehicle_class_index()
+    return {vehicle_id: index.get(str(vehicle_id), (None, None)) for vehicle_id in vehicle_ids}
+
+def normalize_name(name):
+    # Lowercase, drop accents and collapse whitespace so SimHub and Racenet names line up
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(name.casefold().split())
+
+# 根据计时赛前置信息中的routes建立赛段名字索引，前置信息更新时重建
+def build_route_index(pre_info):
+    global route_index, route_match_memo
+    routes = (pre_info or {}).get('routes', {})
+    # Longest names first, so a route whose name contains another route's name wins
+    index = sorted(((normalize_name(route_name), route_id, route_name) for route_id, route_name in routes.items()), key=lambda route: (-len(route[0]), str(route[1])))
+    with route_index_lock:
+        route_index = index
+        route_match_memo = {}
 
 def get_stage_info(track_name):
-    global time_trial_pre_info
-    time_trial_pre_info = get_time_trial_pre_info()
-    stage_info = next(((route_id, route_name) for route_id, route_name in time_trial_pre_info['routes'].items() if route_name.lower() in track_name.lower()), (None, None))
+    get_time_trial_pre_info()
+
+    stage_info = route_match_memo.get(track_name)
+    if stage_info is None:
+        normalized_track_name = normalize_name(track_name)
+        stage_info = next(((route_id, route_name) for name, route_id, route_name in route_index if name and name in normalized_track_name), (None, None))
+        with route_index_lock:
+            route_match_memo[track_name] = stage_info
     return stage_info[0], stage_info[1]
 
 def get_display_name():
-    personal_info = get_personal_info()
-    personal_info_json = personal_info
+    personal_info_json = get_personal_info() or {}
     display_name = personal_info_json.get('displayName', '')
     return display_name
 
@@ -159,23 +1280,26 @@ def get_display_name():
 #
 ############################################################################################
 def get_personal_info(force_update=False):
+    global personal_info
+
+    # Use the copy already loaded in memory
+    if not force_update and personal_info:
+        return personal_info
+
     # Check if the data is already saved in a local file
-    if not force_update and os.path.exists('racenet_personal_info.json'):
-        with open('racenet_personal_info.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
+    if not force_update:
+        data = load_pre_data('racenet_personal_info.json')
+        if data is not None:
+            personal_info = data
+            return data
 
     # Get the data from the API
-    url = "https://web-api.racenet.com/api/identity/secured"
-    headers = {
-       'Authorization': f'Bearer {access_token}',
-       'User-Agent': 'Apifox/1.0.0 (https://apifox.com)'
-    }
-    response = requests.get(url, headers=headers)
+    response = racenet_get('/identity/secured')
     if response.status_code == 200:
         data = json.loads(response.text)
         # Save the data to a local file
-        with open('racenet_personal_info.json', 'w', encoding='utf-8') as f:
-            json.dump(data, f)
+        save_pre_data('racenet_personal_info.json', data)
+        personal_info = data
         print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Personal info saved to: racenet_personal_info.json")
         return data
     else:
@@ -187,45 +1311,56 @@ def get_personal_info(force_update=False):
 # 获取俱乐部的信息：
 #
 ############################################################################################
-# 获取俱乐部列表的函数
+# 获取俱乐部列表的函数：先获取第一页得到俱乐部总数，再并行获取剩下的分页
 def get_club_list(force_update=False):
-    global club_list_data
     take = 20
-    skip = 0
-    club_list_data = {'totalActiveMemberships': 0, 'activeMemberships': []}
+
+    # Use the copy already loaded in memory
+    if not force_update and club_list_data:
+        return club_list_data
 
     # Check if the data is already saved in a local file
-    if not force_update and os.path.exists('racenet_club_list_data.json'):
-        with open('racenet_club_list_data.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
+    if not force_update:
+        data = load_pre_data('racenet_club_list_data.json')
+        if data is not None:
+            set_club_list_data(data)
+            return data
 
-    while True:
-        url = f"https://web-api.racenet.com/api/wrc2023clubs/memberships/active?take={take}&skip={skip}&includeChampionship=true"
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'User-Agent': 'Apifox/1.0.0 (https://apifox.com)'
-        }
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            try:
-                data = response.json()
-                club_list_data['totalActiveMemberships'] = data['totalActiveMemberships']
-                club_list_data['activeMemberships'].extend(data['activeMemberships'])
-                if len(data['activeMemberships']) < take:
-                    break
-                else:
-                    skip += take
-            except json.JSONDecodeError:
-                print("Error: Response is not valid JSON")
-                print("Response: ", response.text)
-        else:
-            print(f"Error: {response.status_code}")
-            print("Response: ", response.text)
-            break
+    # Build the new list on the side, readers keep the old one until it is complete
+    started = time.time()
+    first_page = get_club_list_page(0, take)
+    if first_page is None:
+        return club_list_data
+    pages = [first_page]
+    skips = range(take, first_page['totalActiveMemberships'], take)
+    if skips:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=CLUB_LIST_WORKERS, thread_name_prefix='club_list') as pool:
+            # Each page runs in a copy of this context to keep the request priority
+            tasks = [pool.submit(contextvars.copy_context().run, get_club_list_page, skip, take) for skip in skips]
+            pages.extend(task.result() for task in tasks)
+    if any(page is None for page in pages):
+        return club_list_data
+
+    # Keep going if clubs were joined while paging
+    skip = take * len(pages)
+    while len(pages[-1]['activeMemberships']) >= take and skip < pages[-1]['totalActiveMemberships']:
+        page = get_club_list_page(skip, take)
+        if page is None:
+            return club_list_data
+        pages.append(page)
+        skip += take
+    observe('racenet_club_list_refresh_seconds', time.time() - started)
+
+    # Pages fetched at slightly different times can overlap, keep each club once
+    memberships = {}
+    for page in pages:
+        for membership in page['activeMemberships']:
+            memberships.setdefault(membership['clubID'], membership)
+    club_list = {'totalActiveMemberships': pages[-1]['totalActiveMemberships'], 'activeMemberships': list(memberships.values())}
 
     # Save the data to a local file
-    with open('racenet_club_list_data.json', 'w', encoding='utf-8') as f:
-        json.dump(club_list_data, f, ensure_ascii=False)
+    save_pre_data('racenet_club_list_data.json', club_list)
+    set_club_list_data(club_list)
     print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Club list data saved to: racenet_club_list_data.json")
 
     if DEBUG:
@@ -233,103 +1368,140 @@ def get_club_list(force_update=False):
 
     return club_list_data
 
+def get_club_list_page(skip, take):
+    params = {'take': take, 'skip': skip, 'includeChampionship': 'true'}
+    response = racenet_get('/wrc2023clubs/memberships/active', params)
+    if response.status_code != 200:
+        print(f"Error: {response.status_code}")
+        print("Response: ", response.text)
+        return None
+    try:
+        return response.json()
+    except json.JSONDecodeError:
+        print("Error: Response is not valid JSON")
+        print("Response: ", response.text)
+        return None
 
-# 根据clubName找到匹配的clubID，然后获取该club所有赛事列表的函数
-def get_club_events():
-    global club_list_data, simhub_data, club_events_data
+# 替换俱乐部列表，同时重建俱乐部目录
+def set_club_list_data(data):
+    global club_list_data, club_directory
+    directory = {'name': {}, 'normalized': {}, 'id': {}}
+    for membership in data.get('activeMemberships', []):
+        directory['name'].setdefault(membership['clubName'], membership)
+        directory['normalized'].setdefault(normalize_name(membership['clubName']), membership)
+        directory['id'][str(membership['clubID'])] = membership
+    club_directory = directory
+    club_list_data = data
+
+# 按clubName查找俱乐部，找不到时依次尝试忽略大小写和空格的名字，以及clubID
+def find_club(club_name):
+    get_club_list()
+    directory = club_directory
+    return directory['name'].get(club_name) or directory['normalized'].get(normalize_name(club_name)) or directory['id'].get(club_name)
+
+def parse_racenet_date(value):
+    try:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return None
 
-    club_list_data = get_club_list()
-    # Find the club ID from the club list data
-    club_id = next((item['clubID'] for item in club_list_data['activeMemberships'] if item['clubName'] == simhub_data['clubName']), None)
+# 俱乐部赛事信息只在赛事开始或结束时变化，缓存到下一个开始或结束的时间
+def club_events_ttl(club_events):
+    now = time.time()
+    events = (club_events.get('currentChampionship') or {}).get('events', [])
+    deadlines = [parse_racenet_date(event.get(field)) for event in events for field in ('absoluteOpenDate', 'absoluteCloseDate')]
+    upcoming = [deadline - now for deadline in deadlines if deadline and deadline > now]
+    if not upcoming:
+        return CACHE_TTL['club_meta']
+    return max(1, min(min(upcoming), CLUB_EVENTS_MAX_TTL))
+
+# 根据clubName找到匹配的clubID，然后获取该club所有赛事列表的函数
+def get_club_events(club_name):
+    club = find_club(club_name)
+    club_id = club['clubID'] if club else None
     if club_id is None:
         print("Club not found")
-        return
+        return None
 
     # Get the club events
-    url = f"https://web-api.racenet.com/api/wrc2023clubs/{club_id}?includeChampionship=true"
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'User-Agent': 'Apifox/1.0.0 (https://apifox.com)'
-    }
-    try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            club_events_data = response.json()
-            if DEBUG:
-                logging.debug(f"Club events data: {club_events_data}")
-        else:
-            print(f"Error: {response.status_code}")
-            return
-    except Exception as e:
-        print(f"An error occurred while getting club events: {e}")
-
-# 基于上一步取得的"该club所有赛事列表",再根据我们传递的stageID对应到数据中的routeID，从而获取到对应的leaderboardID，再通过这个leaderboardID获取到当前赛事的排行榜数据
-def get_club_leaderboard(vehicle_class_id, stage_id):
-    global club_events_data, club_leaderboard_data
-
-    # # Get the vehicle class ID
-    # vehicle_class_id, _ = get_vehicle_classes_info(simhub_data['vehicleID'])
+    def fetch():
+        try:
+            response = racenet_get(f'/wrc2023clubs/{club_id}', {'includeChampionship': 'true'})
+            if response.status_code == 200:
+                return response.json()
+            else:
+                print(f"Error: {response.status_code}")
+        except Exception as e:
+            print(f"An error occurred while getting club events: {e}")
+        return None
 
-    # # Get the stage ID
-    # stage_id, stage_name = get_stage_info(simhub_data['trackName'])
+    club_events_data = cached_api_call('club_meta', club_id, fetch, ttl=club_events_ttl)
+    if DEBUG:
+        logging.debug(f"Club events data: {club_events_data}")
+    return club_events_data
 
+# 基于上一步取得的"该club所有赛事列表",再根据我们传递的stageID对应到数据中的routeID，从而获取到对应的leaderboardID，再通过这个leaderboardID获取到当前赛事的排行榜数据
+def get_club_leaderboard(club_events_data, vehicle_class_id, stage_id):
     # Find the event ID from the club events data
     leaderboard_ids = [stage['leaderboardID'] for event in club_events_data['currentChampionship']['events'] for stage in event['stages'] if str(stage['stageSettings']['routeID']) == str(stage_id) and str(event['eventSettings']['vehicleClassID']) == str(vehicle_class_id)]
     if len(leaderboard_ids) > 1:
         print("Warning: Multiple leaderboard with same stage in this club. Using the first one.")
     leaderboard_id = leaderboard_ids[0] if leaderboard_ids else None
+    # The stage is not part of the championship, e.g. driving a stage outside the club event
+    if leaderboard_id is None:
+        if DEBUG:
+            logging.debug(f"No club leaderboard for vehicle_class_id: {vehicle_class_id}, stage_id: {stage_id}")
+        return None
 
-    club_leaderboard_data = {'entries': []}
-    cursor = None
+    club_id = club_events_data['clubID']
 
-    while True:
-        try:
-            # Get the leaderboard data
-            url = f"https://web-api.racenet.com/api/wrc2023clubs/{club_events_data['clubID']}/leaderboard/{leaderboard_id}?SortCumulative=false&MaxResultCount=20&FocusOnMe=false&Platform=0"
-            if cursor:
-                url += f"&Cursor={cursor}"
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'User-Agent': 'Apifox/1.0.0 (https://apifox.com)'
-            }
-            response = requests.get(url, headers=headers)
-            if response.status_code == 200:
-                data = response.json()
-                club_leaderboard_data['entries'].extend(data['entries'])
-                cursor = data.get('next')  # Assuming 'nextCursor' is the key for the next cursor
-                if not cursor or not data['entries']:
-                    break
-            else:
-                print(f"Error: {response.status_code}")
-                break
-        except Exception as e:
-            print(f"An error occurred while getting leaderboard data: {e}")
-            break
+    def fetch():
+        # Get the leaderboard data
+        path = f'/wrc2023clubs/{club_id}/leaderboard/{leaderboard_id}'
+        params = {'SortCumulative': 'false', 'FocusOnMe': 'false', 'Platform': 0}
+        if LEADERBOARD_FETCH_MODE['club'] == 'window':
+            return fetch_leaderboard_window(path, params, 'MaxResultCount', 'FocusOnMe')
+        return sync_leaderboard(('club', club_id, leaderboard_id), path, params, 'Cursor', 'MaxResultCount', CLUB_LEADERBOARD_PAGE_SIZE)
+
+    club_leaderboard_data = cached_api_call('leaderboard', ('club', club_id, leaderboard_id), fetch)
 
     if DEBUG:
         logging.debug(f"vehicle_class_id: {vehicle_class_id}, stage_id: {stage_id}, leaderboard_id: {leaderboard_id}")
         logging.debug(f"Club leaderboard data: {club_leaderboard_data}") 
 
+    return club_leaderboard_data
+
 # 生成最终的JSON数据的函数，从get_club_events函数中，根据当前stageID，获取leaderboardID，route（赛段名称），weatherAndSurface，timeOfDay，serviceArea，distance
 # 基于“当前赛事的排行榜数据”，分析出：rank, displayName, time, differenceToFirst, nationalityID, timePenalty, vehicle, points
 # 合并成一个club_json字典，然后保存到本地文件
-def generate_club_json():
-    global club_json, club_events_data, club_leaderboard_data, simhub_data
+CLUB_ENTRY_FIELDS = ('rank', 'displayName', 'time', 'differenceToFirst', 'nationalityID', 'timePenalty', 'vehicle', 'points')
+TIME_TRIAL_ENTRY_FIELDS = ('rank', 'displayName', 'time', 'differenceToFirst', 'nationalityID', 'timePenalty', 'vehicle', 'splits')
 
-    # Call the necessary functions to get the data
-    # get_club_list()
-    get_club_events()    
-
-    # Get personal info
-    myName = get_display_name()
+def entry_fields(fields, entries):
+    # rankGap is only set in window mode
+    if entries and entries[0].rankGap is not None:
+        return fields + ('rankGap',)
+    return fields
 
-    # Get the vehicle class ID，vehicle class name. stage ID
-    vehicle_class_id, vehicle_class_name = get_vehicle_classes_info(simhub_data['vehicleID'])
+def generate_club_json(session, inputs=None):
+    # Get personal info, the vehicle class ID，vehicle class name and stage ID
+    if inputs is None:
+        inputs = resolve_simhub_inputs(session.data)
 
-    # Get the stage ID
-    stage_id, stage_name = get_stage_info(simhub_data['trackName'])
+    # Call the necessary functions to get the data
+    # get_club_list()
+    club_events_data = get_club_events(inputs['clubName'])
+    if club_events_data is None:
+        print("No data to save.")
+        return
+    myName = inputs['myName']
+    vehicle_class_id, vehicle_class_name = inputs['vehicleClassID'], inputs['vehicleClassName']
+    stage_id = inputs['stageID']
 
-    get_club_leaderboard(vehicle_class_id, stage_id)
+    leaderboard_data = get_club_leaderboard(club_events_data, vehicle_class_id, stage_id)
+    if leaderboard_data is None:
+        print("No data to save.")
+        return
 
     # Find the stage from the club events data
     stage = next((stage for event in club_events_data['currentChampionship']['events'] for stage in event['stages'] if str(stage['stageSettings']['routeID']) == str(stage_id)), None)
@@ -338,19 +1510,8 @@ def generate_club_json():
         print("Stage not found")
         return
 
-    # Generate the final JSON for all leaderboard entries
-    leaderboard_entries = []
-    for leaderboard_entry in club_leaderboard_data['entries']:
-        leaderboard_entries.append({
-            'rank': leaderboard_entry['rank'],
-            'displayName': leaderboard_entry['displayName'],
-            'time': leaderboard_entry['time'],
-            'differenceToFirst': leaderboard_entry['differenceToFirst'],
-            'nationalityID': leaderboard_entry['nationalityID'],
-            'timePenalty': leaderboard_entry['timePenalty'],
-            'vehicle': leaderboard_entry['vehicle'],
-            'points': leaderboard_entry['points']
-        })
+    # Write the final JSON straight from the cached entries
+    leaderboard_entries = LeaderboardTable(leaderboard_data['entries'], entry_fields(CLUB_ENTRY_FIELDS, leaderboard_data['entries']))
 
     club_json = {
         'myName': myName,
@@ -372,11 +1533,13 @@ def generate_club_json():
 
     # Check if the necessary data exists
     if 'clubID' in club_json and 'leaderboardID' in club_json:
-        # Save the JSON data to a file
-        filename = f'racenet_club.json'
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(club_json, f, ensure_ascii=False)
-        print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - JSON data saved to: {filename}")
+        # Save the JSON data to a file, unless the leaderboard hasn't changed
+        filename = session.output_filename('club')
+        encoded, digest = encode_output(club_json)
+        if set_latest_payload(session, 'club', club_json, digest):
+            record_leaderboard_snapshot(f"club:{club_json['leaderboardID']}", leaderboard_entries)
+        if write_json_output(filename, encoded, digest):
+            print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - JSON data saved to: {filename}")
     else:
         print("No data to save.")
 
@@ -386,153 +1549,447 @@ def generate_club_json():
 #
 ############################################################################################
 # 首先通过API获取计时赛前置信息，包括routeID，vehicleClassesID，vehicleID，surfaceConditionID
+def set_time_trial_pre_info(data):
+    global time_trial_pre_info
+    if data is not time_trial_pre_info:
+        time_trial_pre_info = data
+        build_route_index(data)
+
 def get_time_trial_pre_info(force_update=False):
-    # Check if the data is already saved in a local file
-    if not force_update and os.path.exists('racenet_time_trial_pre_info.json'):
-        with open('racenet_time_trial_pre_info.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
+    # Use the copy already loaded in memory
+    if not force_update and time_trial_pre_info:
+        return time_trial_pre_info
 
-    # If not, get the data from the API
-    url = "https://web-api.racenet.com/api/wrc2023Stats/values"
-    headers = {
-       'Authorization': f'Bearer {access_token}',
-       'User-Agent': 'Apifox/1.0.0 (https://apifox.com)'
-    }
-    try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            # Save the data to a local file
-            with open('racenet_time_trial_pre_info.json', 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False)
-            print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Time trial pre-info saved to: racenet_time_trial_pre_info.json")
+    # Check if the data is already saved in a local file
+    if not force_update:
+        data = load_pre_data('racenet_time_trial_pre_info.json')
+        if data is not None:
+            set_time_trial_pre_info(data)
             return data
-        else:
-            print(f"Error: {response.status_code}")
-            print("Response: ", response.text)
-            return None
-    except Exception as e:
-        print(f"An error occurred while getting time trial pre-info: {e}")
-        return None
-
-# 然后根据已知的stageID，vehicleClassesID 以及surfaceConditionID（0,1）获取到当前赛道的排行榜数据
-def get_time_trial_leaderboard(stage_id, vehicle_class_id, surface_condition_id, max_page=1):
-    global access_token, time_trial_leaderboard_data
 
-    url = f"https://web-api.racenet.com/api/wrc2023Stats/leaderboard/{stage_id}/{vehicle_class_id}/{surface_condition_id}?maxResultCount=20&focusOnMe=false&platform=0&cursor"
-    headers = {
-       'Authorization': f'Bearer {access_token}',
-       'User-Agent': 'Apifox/1.0.0 (https://apifox.com)'
-    }
-
-    time_trial_leaderboard_data = {'entries': []}
-    cursor = None
-    pages_fetched = 0
-
-    while True:
-        if cursor:
-            url += f"&Cursor={cursor}"
+    # If not, get the data from the API
+    def fetch():
         try:
-            response = requests.get(url, headers=headers)
+            response = racenet_get('/wrc2023Stats/values')
             if response.status_code == 200:
                 data = response.json()
-                time_trial_leaderboard_data['entries'].extend(data['entries'])
-                cursor = data.get('next')  # Assuming 'nextCursor' is the key for the next cursor
-                pages_fetched += 1
-                if not cursor or not data['entries'] or pages_fetched >= max_page:
-                    break
+                # Save the data to a local file
+                save_pre_data('racenet_time_trial_pre_info.json', data)
+                print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Time trial pre-info saved to: racenet_time_trial_pre_info.json")
+                return data
             else:
                 print(f"Error: {response.status_code}")
-                break
+                print("Response: ", response.text)
+                return None
         except Exception as e:
-            print(f"An error occurred while getting leaderboard data: {e}")
-            break
+            print(f"An error occurred while getting time trial pre-info: {e}")
+            return None
+
+    data = cached_api_call('stats_values', 'values', fetch, force_update=force_update)
+    if data is not None:
+        set_time_trial_pre_info(data)
+    return data
+
+# 然后根据已知的stageID，vehicleClassesID 以及surfaceConditionID（0,1）获取到当前赛道的排行榜数据
+def get_time_trial_leaderboard(stage_id, vehicle_class_id, surface_condition_id, max_page=1):
+    def fetch():
+        path = f'/wrc2023Stats/leaderboard/{stage_id}/{vehicle_class_id}/{surface_condition_id}'
+        params = {'focusOnMe': 'false', 'platform': 0}
+        if LEADERBOARD_FETCH_MODE['time_trial'] == 'window':
+            return fetch_leaderboard_window(path, params, 'maxResultCount', 'focusOnMe')
+        return sync_leaderboard(('time_trial', stage_id, vehicle_class_id, surface_condition_id, max_page), path, params, 'cursor', 'maxResultCount', DEFAULT_PAGE_SIZE, max_page=max_page)
 
-    # # Fetch the user's own leaderboard data
-    # url = f"https://web-api.racenet.com/api/wrc2023Stats/leaderboard/{stage_id}/{vehicle_class_id}/{surface_condition_id}?maxResultCount=20&focusOnMe=true&platform=0&cursor"
-    # try:
-    #     response = requests.get(url, headers=headers)
-    #     if response.status_code == 200:
-    #         data = response.json()
-    #         if data['entries']:
-    #             time_trial_leaderboard_data['entries'].append(data['entries'][0])  # Assuming the user's data is the first entry
-    #         else:
-    #             print("User's data not found")
-    # except Exception as e:
-    #     print(f"An error occurred while getting user's leaderboard data: {e}")
+    time_trial_leaderboard_data = cached_api_call('leaderboard', ('time_trial', stage_id, vehicle_class_id, surface_condition_id, max_page), fetch)
 
     if DEBUG:
         logging.debug(f"Time trial leaderboard data for {surface_condition_id} condition: {time_trial_leaderboard_data}")
 
     return time_trial_leaderboard_data
 
-# 获取到当前赛道的排行榜数据(比如：rank, displayName, time, differenceToFirst, nationalityID, timePenalty, vehicle, splits)
-def generate_time_trial_json():
-    global simhub_data, time_trial_leaderboard_data
-
-    # Get personal info
-    myName = get_display_name()
-
-    # Get the vehicle class ID and name
-    vehicle_class_id, vehicle_class_name = get_vehicle_classes_info(simhub_data['vehicleID'])
-
-    # Get the stage ID
-    stage_id, stage_name = get_stage_info(simhub_data['trackName'])
-
-    # Generate JSON for dry and wet conditions
-    for surface_condition_id, condition in [(0, 'dry'), (1, 'wet')]:
-        leaderboard_entries = []
-        get_time_trial_leaderboard(stage_id, vehicle_class_id, surface_condition_id, max_page=1)
-        if time_trial_leaderboard_data:
-            # Generate the final JSON for all leaderboard entries
-            for leaderboard_entry in time_trial_leaderboard_data['entries']:
-                leaderboard_entries.append({
-                    'rank': leaderboard_entry['rank'],
-                    'displayName': leaderboard_entry['displayName'],
-                    'time': leaderboard_entry['time'],
-                    'differenceToFirst': leaderboard_entry['differenceToFirst'],
-                    'nationalityID': leaderboard_entry['nationalityID'],
-                    'timePenalty': leaderboard_entry['timePenalty'],
-                    'vehicle': leaderboard_entry['vehicle'],
-                    'splits': leaderboard_entry['splits']
-                })
-
-        time_trial_json = {
-            'myName': myName,
-            'stageID': stage_id,
-            'route': stage_name,
-            'vehicleClassID': vehicle_class_id,
-            'vehicleClassName': vehicle_class_name,
-            'surfaceCondition': condition,
-            'lastUpdated': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'leaderboardEntries': leaderboard_entries
-        }
+# 获取到当前赛道某个路况的排行榜数据(比如：rank, displayName, time, differenceToFirst, nationalityID, timePenalty, vehicle, splits)，干燥和潮湿路况由generate_json_data分别生成
+def generate_time_trial_condition_json(session, inputs, surface_condition_id, condition):
+    leaderboard_data = get_time_trial_leaderboard(inputs['stageID'], inputs['vehicleClassID'], surface_condition_id, max_page=1)
+    # A failed fetch keeps the last board, an empty board comes back as an empty list
+    if leaderboard_data is None:
+        print("No data to save.")
+        return
+    entries = leaderboard_data['entries']
+    # Write the final JSON straight from the cached entries
+    leaderboard_entries = LeaderboardTable(entries, entry_fields(TIME_TRIAL_ENTRY_FIELDS, entries))
+
+    analytics = {}
+    if TIME_TRIAL_ANALYTICS and np is not None:
+        with timed('racenet_split_analytics_seconds'):
+            analytics = analyze_time_trial_splits(leaderboard_entries, inputs['myName'])
+
+    time_trial_json = {
+        'myName': inputs['myName'],
+        'stageID': inputs['stageID'],
+        'route': inputs['stageName'],
+        'vehicleClassID': inputs['vehicleClassID'],
+        'vehicleClassName': inputs['vehicleClassName'],
+        'surfaceCondition': condition,
+        'lastUpdated': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'leaderboardEntries': leaderboard_entries,
+        **analytics
+    }
 
-        # Save the JSON data to a file
-        filename = f'racenet_time_trial_{condition}.json'
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(time_trial_json, f, ensure_ascii=False)
+    # Save the JSON data to a file, unless the leaderboard hasn't changed
+    filename = session.output_filename(f'time_trial_{condition}')
+    encoded, digest = encode_output(time_trial_json)
+    if set_latest_payload(session, f'time_trial_{condition}', time_trial_json, digest):
+        record_leaderboard_snapshot(f"time_trial:{inputs['stageID']}:{inputs['vehicleClassID']}:{surface_condition_id}", leaderboard_entries)
+    if write_json_output(filename, encoded, digest):
         print(f"{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - JSON data saved to: {filename}")
 
+############################################################################################
+#
+# 计时赛分段分析：把整个排行榜的分段时间放进一个矩阵，一次算出所有车手每个分段的时间差和排名
+#
+############################################################################################
+# Racenet times look like 00:04:12.3450000, the same strings come back on every refresh
+@functools.lru_cache(maxsize=65536)
+def parse_racenet_time(value):
+    try:
+        hours, minutes, seconds = value.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except (AttributeError, ValueError):
+        return float('nan')
+
+def to_json_values(values, decimals=3):
+    # NaN marks a missing split and becomes null, whole numbers are written as integers
+    rounded = (np.nan_to_num(values).astype(np.int64) if decimals == 0 else np.round(values, decimals)).astype(object)
+    rounded[np.isnan(values)] = None
+    return rounded.tolist()
+
+# splits是到达每个分段点的累计时间，最后一列加上完成时间；每个车手增加以下列（每个分段点和终点各一个值，单位：秒）：
+# splitDeltaToFirst, splitDeltaToMe, splitDeltaToAhead 和 sectorRanks（该分段用时在排行榜中的排名）
+# 排行榜增加 theoreticalBestSplits 和 theoreticalBestTime：每个分段都用最快的用时
+def analyze_time_trial_splits(table, my_name):
+    entries = table.entries
+    if not entries:
+        return {}
+    split_count = max(len(entry.splits or []) for entry in entries)
+
+    # One row per driver, entries with a different number of splits only get the finish time
+    cumulative = np.full((len(entries), split_count + 1), np.nan)
+    for row, entry in enumerate(entries):
+        splits = entry.splits or []
+        if len(splits) == split_count:
+            cumulative[row, :split_count] = [parse_racenet_time(split) for split in splits]
+        cumulative[row, split_count] = parse_racenet_time(entry.time)
+
+    # Entries are in rank order, so row 0 is the leader and row - 1 is the car ahead
+    to_first = cumulative - cumulative[0]
+    to_ahead = np.full_like(cumulative, np.nan)
+    to_ahead[1:] = cumulative[1:] - cumulative[:-1]
+    # In window mode the previous row is not the car ahead when ranks were skipped in between
+    for row in range(1, len(entries)):
+        entry, previous = entries[row], entries[row - 1]
+        if entry.rankGap or not isinstance(entry.rank, int) or not isinstance(previous.rank, int) or entry.rank != previous.rank + 1:
+            to_ahead[row] = np.nan
+    me = next((row for row, entry in enumerate(entries) if entry.displayName == my_name), None)
+    to_me = cumulative - cumulative[me] if me is not None else np.full_like(cumulative, np.nan)
+
+    # Ties share the better rank, missing sectors sort last and are masked afterwards
+    sectors = np.diff(cumulative, axis=1, prepend=0)
+    ordered = np.sort(sectors, axis=0)
+    sector_ranks = np.column_stack([np.searchsorted(ordered[:, column], sectors[:, column]) + 1 for column in range(sectors.shape[1])]).astype(float)
+    sector_ranks[np.isnan(sectors)] = np.nan
+
+    # fmin skips NaN without warning about sectors nobody has a time for
+    best_splits = np.cumsum(np.fmin.reduce(sectors, axis=0))
+
+    # The entries are shared with the cache, the results go into this output's columns
+    table.columns.update({
+        'splitDeltaToFirst': to_json_values(to_first),
+        'splitDeltaToMe': to_json_values(to_me),
+        'splitDeltaToAhead': to_json_values(to_ahead),
+        'sectorRanks': to_json_values(sector_ranks, 0)
+    })
+
+    best = to_json_values(best_splits)
+    return {'theoreticalBestSplits': best, 'theoreticalBestTime': best[-1]}
+
+############################################################################################
+#
+# JSON编码：格式和json.dumps(ensure_ascii=False)相同，LeaderboardTable直接从条目的字段逐行写出
+#
+############################################################################################
+encode_json_string = json.encoder.encode_basestring
+
+def encode_json_value(value):
+    # Strings, ints and null are most of a leaderboard, everything else goes through json
+    if type(value) is str:
+        return encode_json_string(value)
+    if value is None:
+        return 'null'
+    if type(value) is int:
+        return int.__repr__(value)
+    return json.dumps(value, ensure_ascii=False)
+
+def iter_json(value):
+    if isinstance(value, LeaderboardTable):
+        yield from value.iter_json()
+    elif isinstance(value, dict):
+        yield '{'
+        for index, (key, item) in enumerate(value.items()):
+            yield f'{", " if index else ""}{encode_json_string(str(key))}: '
+            yield from iter_json(item)
+        yield '}'
+    else:
+        yield encode_json_value(value)
+
+def encode_json_column(values):
+    # Whole columns of strings or ints are encoded without a Python call per value
+    values = list(values)
+    types = set(map(type, values))
+    if types == {str}:
+        return list(map(encode_json_string, values))
+    if types == {int}:
+        return list(map(int.__repr__, values))
+    if values and types <= {tuple, list}:
+        items = list(itertools.chain.from_iterable(values))
+        item_types = set(map(type, items))
+        # Lists of numbers or strings without brackets, like splits and the split analytics: dump the whole column once and cut it per entry
+        if item_types <= {int, float, type(None)} or (item_types == {str} and ']' not in ''.join(items)):
+            rows = ['[' + part + ']' for part in json.dumps(values, ensure_ascii=False)[1:-1].split('], [')]
+            # The first and last pieces kept their own bracket
+            rows[0] = rows[0][1:]
+            rows[-1] = rows[-1][:-1]
+            return rows
+    return list(map(encode_json_value, values))
+
+def encode_json(value):
+    return ''.join(iter_json(value))
+
 ############################################################################################
 # 
-# 循环保存JSON文件
+# 保存生成的JSON文件：内容没有变化时跳过写入，否则先写临时文件再替换，避免Overlay读到写了一半的文件
 # 
 ############################################################################################
-def save_json_periodically():
-    global SAVE_INTERVAL, simhub_data
-    last_save_time = time.time()
+def encode_output(data, ignore_keys=('lastUpdated',)):
+    # Encode every value once, the same text is hashed (without ignore_keys) and written
+    encoded = {key: encode_json(value) for key, value in data.items()}
+    digest = hashlib.sha1('\n'.join(f'{key}={value}' for key, value in encoded.items() if key not in ignore_keys).encode('utf-8')).hexdigest()
+    return encoded, digest
+
+def write_json_output(filename, encoded, digest):
+    with output_lock:
+        if output_hashes.get(filename) == digest and os.path.exists(filename):
+            output_write_stats['skipped'] += 1
+            if DEBUG:
+                logging.debug(f"{filename} unchanged, write skipped. Output stats: {output_write_stats}")
+            return False
+
+    temp_filename = f'{filename}.{threading.get_ident()}.tmp'
+    try:
+        with timed('racenet_output_write_seconds', filename=filename):
+            with open(temp_filename, 'w', encoding='utf-8') as f:
+                f.write('{' + ', '.join(f'{encode_json_string(key)}: {value}' for key, value in encoded.items()) + '}')
+                f.flush()
+                os.fsync(f.fileno())
+            size = os.path.getsize(temp_filename)
+            os.replace(temp_filename, filename)
+    except OSError as e:
+        # The hash isn't updated, so the next generation tries again
+        print(f"Error: Could not save {filename}: {e}")
+        return False
+    finally:
+        remove_temp_file(temp_filename)
+
+    with output_lock:
+        output_hashes[filename] = digest
+        output_write_stats['written'] += 1
+        output_write_stats['bytesWritten'] += size
+    return True
+
+############################################################################################
+# 
+# 排行榜历史：每次排行榜有变化时在SQLite中保存一份快照，可以比较任意两份快照之间的变化
+# board_key为 club:<leaderboardID> 或 time_trial:<stageID>:<vehicleClassID>:<surfaceConditionID>
+# 
+############################################################################################
+def get_history_db():
+    global history_db
+    if history_db is None:
+        history_db = sqlite3.connect(HISTORY_DB, check_same_thread=False)
+        history_db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        history_db.execute('PRAGMA journal_mode = WAL')
+        history_db.executescript('''
+            CREATE TABLE IF NOT EXISTS snapshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                board_key TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_snapshots_board ON snapshots (board_key, created_at);
+            CREATE TABLE IF NOT EXISTS snapshot_entries (
+                snapshot_id INTEGER NOT NULL,
+                display_name TEXT NOT NULL,
+                rank INTEGER,
+                time TEXT,
+                time_penalty TEXT,
+                points INTEGER,
+                PRIMARY KEY (snapshot_id, display_name)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_entries_driver ON snapshot_entries (display_name, time);
+        ''')
+    return history_db
+
+def record_leaderboard_snapshot(board_key, leaderboard_entries):
+    global history_last_compacted
+    has_points = 'points' in leaderboard_entries.fields
+    rows = [(entry.displayName, entry.rank, entry.time, entry.timePenalty, entry.points if has_points else None) for entry in leaderboard_entries.entries]
+    rows_hash = hash(tuple(rows))
+    try:
+        with history_db_lock:
+            if history_last_rows.get(board_key) == rows_hash:
+                return
+            db = get_history_db()
+            # Write the whole snapshot in a single transaction
+            with db:
+                snapshot_id = db.execute('INSERT INTO snapshots (board_key, created_at) VALUES (?, ?)', (board_key, time.time())).lastrowid
+                db.executemany('INSERT OR IGNORE INTO snapshot_entries VALUES (?, ?, ?, ?, ?, ?)', [(snapshot_id, *row) for row in rows])
+            history_last_rows[board_key] = rows_hash
+            if time.time() - history_last_compacted >= HISTORY_COMPACT_INTERVAL:
+                compact_history(db)
+                history_last_compacted = time.time()
+    except sqlite3.Error as e:
+        print(f"An error occurred while saving leaderboard history: {e}")
+
+# 删除超过保留天数的快照，以及每个排行榜超出数量上限的旧快照
+def compact_history(db):
+    with db:
+        db.execute('DELETE FROM snapshots WHERE created_at < ?', (time.time() - HISTORY_RETENTION_DAYS * 86400,))
+        db.execute('''
+            DELETE FROM snapshots WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY board_key ORDER BY created_at DESC) AS age FROM snapshots
+                ) WHERE age > ?
+            )''', (HISTORY_MAX_SNAPSHOTS_PER_BOARD,))
+        db.execute('DELETE FROM snapshot_entries WHERE snapshot_id NOT IN (SELECT id FROM snapshots)')
+    db.execute('PRAGMA incremental_vacuum')
+
+def list_leaderboard_snapshots(board_key, limit=50):
+    with history_db_lock:
+        rows = get_history_db().execute('SELECT id, created_at FROM snapshots WHERE board_key = ? ORDER BY created_at DESC LIMIT ?', (board_key, limit)).fetchall()
+    return [{'snapshotID': snapshot_id, 'createdAt': datetime.datetime.fromtimestamp(created_at).strftime('%Y-%m-%d %H:%M:%S')} for snapshot_id, created_at in rows]
+
+# 比较两份快照，返回新增、移除、排名或成绩有变化的车手
+def get_leaderboard_deltas(from_snapshot_id, to_snapshot_id):
+    query = 'SELECT display_name, rank, time FROM snapshot_entries WHERE snapshot_id = ?'
+    with history_db_lock:
+        db = get_history_db()
+        old_entries = {name: (rank, entry_time) for name, rank, entry_time in db.execute(query, (from_snapshot_id,))}
+        new_entries = {name: (rank, entry_time) for name, rank, entry_time in db.execute(query, (to_snapshot_id,))}
+
+    deltas = []
+    for name, (rank, entry_time) in new_entries.items():
+        if name not in old_entries:
+            deltas.append({'displayName': name, 'status': 'added', 'rank': rank, 'time': entry_time})
+            continue
+        old_rank, old_time = old_entries[name]
+        if rank != old_rank or entry_time != old_time:
+            deltas.append({
+                'displayName': name,
+                'status': 'changed',
+                'rank': rank,
+                'previousRank': old_rank,
+                # Rows without a rank or time leave the comparison empty
+                'rankChange': old_rank - rank if rank is not None and old_rank is not None else None,
+                'time': entry_time,
+                'previousTime': old_time,
+                'timeImproved': entry_time < old_time if entry_time is not None and old_time is not None else None
+            })
+    for name, (rank, entry_time) in old_entries.items():
+        if name not in new_entries:
+            deltas.append({'displayName': name, 'status': 'removed', 'previousRank': rank, 'previousTime': entry_time})
+    return deltas
+
+@app.route('/history/snapshots', methods=['GET'])
+def get_history_snapshots():
+    board_key = request.args.get('board', '')
+    return jsonify(list_leaderboard_snapshots(board_key, request.args.get('limit', 50, type=int)))
+
+@app.route('/history/deltas', methods=['GET'])
+def get_history_deltas():
+    from_snapshot_id = request.args.get('from', type=int)
+    to_snapshot_id = request.args.get('to', type=int)
+    if from_snapshot_id is None or to_snapshot_id is None:
+        return jsonify({'error': 'Both from and to snapshot IDs are required'}), 400
+    return jsonify(get_leaderboard_deltas(from_snapshot_id, to_snapshot_id))
+
+############################################################################################
+# 
+# 后台刷新：每类数据按各自的时间间隔刷新，到期的任务按优先级执行；并预先获取当前锦标赛所有赛段的俱乐部排行榜
+# 
+############################################################################################
+def schedule_refresh(kind, delay=0):
+    deadline = time.time() + delay
+    with refresh_condition:
+        refresh_deadlines[kind] = deadline
+        refresh_condition.notify()
+
+def refresh_scheduler():
+    # Startup data is fetched by fetch_pre_data, so everything starts one interval from now
+    for kind, interval in REFRESH_INTERVALS.items():
+        schedule_refresh(kind, interval)
+
     while True:
-        if simhub_data and time.time() - last_save_time >= SAVE_INTERVAL:
-            generate_time_trial_json()
-            generate_club_json()
-            last_save_time = time.time()
-        time.sleep(1)  # Sleep for a short time to prevent high CPU usage
+        with refresh_condition:
+            while True:
+                now = time.time()
+                due = [kind for kind, deadline in refresh_deadlines.items() if deadline <= now]
+                if due:
+                    break
+                refresh_condition.wait(min(refresh_deadlines.values()) - now if refresh_deadlines else None)
+            kind = min(due, key=lambda kind: (REFRESH_PRIORITIES[kind], refresh_deadlines[kind]))
+            del refresh_deadlines[kind]
 
-def save_json():
-    if simhub_data:
-        generate_time_trial_json()
-        generate_club_json()
+        if DEBUG:
+            logging.debug(f"Running refresh task: {kind}")
+        priority_token = request_priority.set(REFRESH_PRIORITIES[kind])
+        try:
+            REFRESH_TASKS[kind]()
+        except Exception as e:
+            print(f"An error occurred while refreshing {kind}: {e}")
+        finally:
+            request_priority.reset(priority_token)
+        schedule_refresh(kind, REFRESH_INTERVALS[kind])
+
+# 刷新活跃会话的排行榜，顺便移除长时间没有收到SimHub请求的会话；
+# 所有会话共用输出文件时只刷新最近的会话，否则之前的赛段会覆盖当前赛段的文件
+def refresh_current():
+    expire_sessions()
+    refreshed = active_sessions() if SESSION_OUTPUT_FILES else [latest_session]
+    for session in refreshed:
+        if session is not None:
+            session.request_generation()
+
+# 预先获取每个活跃会话所在俱乐部锦标赛所有赛段的俱乐部排行榜；排行榜的缓存只有15秒，但增量同步的快照会保留下来，
+# 换到这些赛段时只需要获取有变化的页。计时赛只获取第一页，没有快照可以沿用，所以不预先获取
+def prefetch_championship():
+    # Sessions on different stages of the same club share one prefetch
+    for club_name in {session.data['clubName'] for session in active_sessions()}:
+        club_events_data = get_club_events(club_name)
+        if not club_events_data:
+            continue
+
+        events = club_events_data['currentChampionship']['events']
+        # IDs are strings everywhere else, so the prefetched data lands on the same cache keys
+        club_stages = {(str(event['eventSettings']['vehicleClassID']), str(stage['stageSettings']['routeID'])) for event in events for stage in event['stages']}
+        for event_vehicle_class_id, route_id in club_stages:
+            get_club_leaderboard(club_events_data, event_vehicle_class_id, route_id)
+
+        if DEBUG:
+            logging.debug(f"Prefetched {len(club_stages)} club leaderboards for {club_name}")
+
+REFRESH_TASKS = {
+    'current': refresh_current,
+    'prefetch': prefetch_championship,
+    'club_list': lambda: get_club_list(force_update=True),
+    'stats_values': lambda: get_time_trial_pre_info(force_update=True),
+}
 
 if __name__ == '__main__':
     # 如果存在refresh_token.txt文件，就从文件中读取refresh_token
@@ -542,8 +1999,21 @@ if __name__ == '__main__':
     else:
         refresh_token = input("Please enter a valid refresh token: ")
 
+    # Serve the saved data right away, fetch_pre_data replaces it in the background
+    if WARM_START:
+        warm_start()
+
     start_refresh_token_thread()
     start_pre_data_fetching_thread()
-    start_save_json_thread()
+    start_refresh_scheduler_thread()
+    start_generation_worker_thread()
 
-    app.run(port=5000)
\ No newline at end of file
+    # waitress handles concurrent overlays and /stream clients better than the Flask development server
+    try:
+        import waitress
+    except ImportError:
+        waitress = None
+    if waitress:
+        waitress.serve(app, host=SERVER_HOST, port=SERVER_PORT, threads=SERVER_THREADS)
+    else:
+        app.run(host=SERVER_HOST, port=SERVER_PORT, threaded=True)
\ No newline at end of file
@@ -0,0 +1,351 @@
+import json
+import queue
+import time
+
+import pytest
+
+import server
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+############################################################################################
+#
+# JSON编码：LeaderboardTable的输出必须和json.dumps(ensure_ascii=False)完全相同
+#
+############################################################################################
+def make_table(rows, fields, columns=None):
+    return server.LeaderboardTable([server.LeaderboardEntry(row) for row in rows], fields, columns)
+
+def expected_json(table):
+    return json.dumps([dict(zip(table.names(), row)) for row in table.rows()], ensure_ascii=False)
+
+@pytest.mark.parametrize('names', [
+    ['plain', 'with "quotes"', 'back\\slash', '{braces}', '], [', 'a], [b', '车手', ''],
+    ['{}', '{0}', '"], ["'],
+])
+def test_encoder_matches_json_dumps_for_strings(names):
+    table = make_table([{'rank': i + 1, 'displayName': name, 'splits': [name, name]} for i, name in enumerate(names)], ('rank', 'displayName', 'splits'))
+    assert server.encode_json(table) == expected_json(table)
+
+@pytest.mark.parametrize('splits', [
+    [[], [], []],
+    [['00:01:00'], [], ['00:01:02', '00:02:00']],
+    [[1, 2.5], [None], []],
+    [[1.25, float('nan')]],
+    [[]],
+])
+def test_encoder_matches_json_dumps_for_list_columns(splits):
+    table = make_table([{'rank': i + 1, 'splits': row} for i, row in enumerate(splits)], ('rank', 'splits'), {'deltas': [list(row) for row in splits]})
+    assert server.encode_json(table) == expected_json(table)
+
+def test_encoder_matches_json_dumps_for_bools_and_floats():
+    rows = [{'rank': 1, 'points': True}, {'rank': 2, 'points': False}, {'rank': 3, 'points': 1.5}, {'rank': 4, 'points': None}]
+    table = make_table(rows, ('rank', 'points'), {'flags': [True, False, True, False], 'ratio': [0.1, 2.0, 1e-7, 3]})
+    assert server.encode_json(table) == expected_json(table)
+    data = {'leaderboardEntries': table, 'total': 4, 'best': [1.5, None], 'ok': True}
+    assert server.encode_json(data) == json.dumps(dict(data, leaderboardEntries=json.loads(expected_json(table))), ensure_ascii=False)
+
+def test_encoder_projection_and_empty_table():
+    table = make_table([{'rank': 1, 'displayName': 'A'}, {'rank': 2, 'displayName': 'B'}], ('rank', 'displayName'), {'gap': [0, 1]})
+    projected = table.project(top=1, fields=['gap'])
+    assert server.encode_json(projected) == expected_json(projected)
+    assert server.encode_json(make_table([], ('rank',))) == '[]'
+
+############################################################################################
+#
+# 从内存提供排行榜数据
+#
+############################################################################################
+def test_overlay_top_parameter(monkeypatch):
+    session = server.Session('Club', 'Vinnoe Reverse', '82')
+    session.payloads['club'] = {'leaderboardEntries': make_table([{'rank': 1, 'displayName': 'A'}, {'rank': 2, 'displayName': 'B'}], ('rank', 'displayName'))}
+    monkeypatch.setattr(server, 'latest_session', session)
+    client = server.app.test_client()
+
+    assert [entry['displayName'] for entry in client.get('/overlay/club?top=1').get_json()['leaderboardEntries']] == ['A']
+    assert client.get('/overlay/club?top=0').get_json()['leaderboardEntries'] == []
+    assert client.get('/overlay/club?top=-1').status_code == 400
+
+############################################################################################
+#
+# 会话：所有会话共用输出文件时，文件里必须是最近一个会话的数据
+#
+############################################################################################
+class QueueDrained(Exception):
+    pass
+
+class DrainedQueue(queue.Queue):
+    # Lets the test run generation_worker in its own thread until the queue is empty
+    def get(self, *args, **kwargs):
+        if self.empty():
+            raise QueueDrained
+        return super().get(block=False)
+
+@pytest.fixture
+def shared_output(monkeypatch):
+    generated = []
+    monkeypatch.setattr(server, 'SESSION_OUTPUT_FILES', False)
+    monkeypatch.setattr(server, 'GENERATION_DEBOUNCE', 0)
+    monkeypatch.setattr(server, 'sessions', {})
+    monkeypatch.setattr(server, 'latest_session', None)
+    monkeypatch.setattr(server, 'last_output_session', None)
+    monkeypatch.setattr(server, 'generation_queue', DrainedQueue())
+    monkeypatch.setattr(server, 'generate_json_data', lambda session: generated.append(session.data['trackName']))
+    return generated
+
+def poll(track_name):
+    session, _ = server.get_session('Club', track_name, '82')
+    session.request_generation()
+
+def run_generation_worker():
+    with pytest.raises(QueueDrained):
+        server.generation_worker()
+
+def test_switching_back_to_a_stage_rewrites_shared_files(shared_output):
+    for track_name in ['A', 'B', 'A']:
+        poll(track_name)
+        run_generation_worker()
+    assert shared_output == ['A', 'B', 'A']
+
+    # Polling the same stage again right away keeps the fresh files
+    poll('A')
+    run_generation_worker()
+    assert shared_output == ['A', 'B', 'A']
+
+def test_older_queued_session_does_not_overwrite_shared_files(shared_output):
+    poll('A')
+    poll('B')
+    run_generation_worker()
+    assert shared_output == ['B']
+
+############################################################################################
+#
+# 排行榜增量同步
+#
+############################################################################################
+@pytest.fixture
+def fake_board(monkeypatch):
+    board = [{'displayName': f'D{i}', 'time': f'00:03:{i:02d}.0000000'} for i in range(50)]
+    failing_cursors = set()
+
+    def fake_get(path, params=None, **kwargs):
+        cursor = int(params.get('Cursor') or 0)
+        if cursor in failing_cursors:
+            return FakeResponse(503)
+        size = params['MaxResultCount']
+        page = [dict(entry, rank=rank + 1) for rank, entry in enumerate(board)][cursor:cursor + size]
+        return FakeResponse(200, {'entries': page, 'next': str(cursor + size) if cursor + size < len(board) else None, 'totalEntryCount': len(board)})
+
+    monkeypatch.setattr(server, 'racenet_get', fake_get)
+    monkeypatch.setattr(server, 'get_display_name', lambda: 'Me')
+    monkeypatch.setattr(server, 'leaderboard_snapshots', server.collections.OrderedDict())
+    return board, failing_cursors
+
+def sync():
+    return server.sync_leaderboard(('club', '1', 'LB'), '/wrc2023clubs/1/leaderboard/LB', {}, 'Cursor', 'MaxResultCount', 10)
+
+def test_incremental_sync_merges_driver_moving_up(fake_board):
+    board, _ = fake_board
+    assert [entry.displayName for entry in sync()['entries']] == [entry['displayName'] for entry in board]
+
+    # D34 jumps to the top, pages 1-4 change and page 5 still matches the snapshot
+    board.insert(0, board.pop(34))
+    entries = sync()['entries']
+    assert [entry.displayName for entry in entries] == [entry['displayName'] for entry in board]
+    assert [entry.rank for entry in entries] == list(range(1, 51))
+
+def test_incremental_sync_shows_own_improvement_below_matching_pages(monkeypatch, fake_board):
+    board, _ = fake_board
+    monkeypatch.setattr(server, 'get_display_name', lambda: 'D44')
+    sync()
+
+    # Page 1 is unchanged, but the driver moved from rank 45 to 13
+    board.insert(12, board.pop(44))
+    entries = sync()['entries']
+    assert [entry.displayName for entry in entries] == [entry['displayName'] for entry in board]
+    assert entries[12].displayName == 'D44' and entries[12].rank == 13
+
+def test_incremental_sync_refetches_when_a_driver_is_added(fake_board):
+    board, _ = fake_board
+    sync()
+
+    board.insert(20, {'displayName': 'New', 'time': '00:03:19.5000000'})
+    entries = sync()['entries']
+    assert [entry.displayName for entry in entries] == [entry['displayName'] for entry in board]
+
+def test_page_size_fallback_is_remembered_once_it_works(monkeypatch):
+    requested = []
+
+    def fake_get(path, params=None, **kwargs):
+        requested.append((path, params['MaxResultCount']))
+        if params['MaxResultCount'] > server.DEFAULT_PAGE_SIZE or path.endswith('/None'):
+            return FakeResponse(400)
+        return FakeResponse(200, {'entries': [], 'next': None})
+
+    monkeypatch.setattr(server, 'racenet_get', fake_get)
+    monkeypatch.setattr(server, 'leaderboard_snapshots', server.collections.OrderedDict())
+    monkeypatch.setattr(server, 'leaderboard_page_sizes', {})
+
+    # A board that fails at any size doesn't change the page size
+    assert server.sync_leaderboard(('club', '1', 'None'), '/wrc2023clubs/1/leaderboard/None', {}, 'Cursor', 'MaxResultCount', 100) is None
+    assert server.leaderboard_page_sizes == {}
+
+    assert server.sync_leaderboard(('club', '1', 'LB'), '/wrc2023clubs/1/leaderboard/LB', {}, 'Cursor', 'MaxResultCount', 100) == {'entries': []}
+    assert server.leaderboard_page_sizes == {'club': server.DEFAULT_PAGE_SIZE}
+
+    # The next board starts at the size that worked
+    del requested[:]
+    server.sync_leaderboard(('club', '1', 'LB2'), '/wrc2023clubs/1/leaderboard/LB2', {}, 'Cursor', 'MaxResultCount', 100)
+    assert requested == [('/wrc2023clubs/1/leaderboard/LB2', server.DEFAULT_PAGE_SIZE)]
+
+def test_failed_sync_without_snapshot_returns_none(fake_board):
+    _, failing_cursors = fake_board
+    failing_cursors.add(0)
+    assert sync() is None
+    assert ('club', '1', 'LB') not in server.leaderboard_snapshots
+
+def test_failed_incremental_sync_keeps_the_snapshot(fake_board):
+    board, failing_cursors = fake_board
+    snapshot_entries = sync()['entries']
+
+    board.insert(0, board.pop(34))
+    failing_cursors.add(10)
+    assert sync() is None
+    assert server.leaderboard_snapshots[('club', '1', 'LB')]['entries'] == snapshot_entries
+
+    # The next sync fetches the changed pages again
+    failing_cursors.clear()
+    assert [entry.displayName for entry in sync()['entries']] == [entry['displayName'] for entry in board]
+
+############################################################################################
+#
+# 生成排行榜：获取失败时不写入空的排行榜
+#
+############################################################################################
+CLUB_EVENTS = {'clubID': '1', 'clubName': 'Club', 'currentChampionship': {'events': [
+    {'eventSettings': {'vehicleClassID': 1}, 'stages': [
+        {'leaderboardID': 'LB', 'stageSettings': {'routeID': 2, 'route': 'Vinnoe Reverse', 'weatherAndSurface': 'Dry', 'timeOfDay': 'Day', 'serviceArea': 'None', 'distance': 10}}]}]}}
+INPUTS = {'clubName': 'Club', 'myName': 'Me', 'vehicleClassID': '1', 'vehicleClassName': 'H1', 'stageID': '2', 'stageName': 'Vinnoe Reverse'}
+
+@pytest.fixture
+def failing_racenet(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(server, 'api_cache', server.collections.OrderedDict())
+    monkeypatch.setattr(server, 'get_club_events', lambda club_name: CLUB_EVENTS)
+    monkeypatch.setattr(server, 'get_display_name', lambda: 'Me')
+    monkeypatch.setattr(server, 'racenet_get', lambda path, params=None, **kwargs: FakeResponse(503))
+    return tmp_path
+
+def test_window_mode_failure_writes_no_club_board(monkeypatch, failing_racenet):
+    monkeypatch.setitem(server.LEADERBOARD_FETCH_MODE, 'club', 'window')
+    session = server.Session('Club', 'Vinnoe Reverse', '82')
+    server.generate_club_json(session, INPUTS)
+    assert session.payloads == {}
+    assert list(failing_racenet.iterdir()) == []
+
+def test_stage_outside_the_championship_requests_no_club_board(monkeypatch, failing_racenet):
+    requested = []
+    monkeypatch.setattr(server, 'racenet_get', lambda path, params=None, **kwargs: requested.append(path))
+    assert server.get_club_leaderboard(CLUB_EVENTS, '1', '99') is None
+    assert requested == []
+
+def test_failed_sync_is_not_cached_or_written(failing_racenet):
+    assert server.get_club_leaderboard(CLUB_EVENTS, '1', '2') is None
+    assert server.api_cache == {}
+
+    session = server.Session('Club', 'Vinnoe Reverse', '82')
+    server.generate_club_json(session, INPUTS)
+    server.generate_time_trial_condition_json(session, INPUTS, 0, 'dry')
+    assert session.payloads == {}
+    assert list(failing_racenet.iterdir()) == []
+
+############################################################################################
+#
+# 保存文件：替换失败时（Windows上Overlay打开着文件）不留下临时文件
+#
+############################################################################################
+def test_failed_replace_removes_the_temp_file(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(server, 'output_hashes', {})
+
+    def locked(source, target):
+        raise PermissionError(13, 'The process cannot access the file because it is being used by another process')
+
+    replace = server.os.replace
+    monkeypatch.setattr(server.os, 'replace', locked)
+    encoded, digest = server.encode_output({'total': 1})
+    assert server.write_json_output('racenet_club.json', encoded, digest) is False
+    server.save_pre_data('racenet_club_list_data.json', {'clubs': []})
+    assert list(tmp_path.iterdir()) == []
+
+    # The next write goes through once the file is free again
+    monkeypatch.setattr(server.os, 'replace', replace)
+    assert server.write_json_output('racenet_club.json', encoded, digest) is True
+    assert [path.name for path in tmp_path.iterdir()] == ['racenet_club.json']
+
+############################################################################################
+#
+# 排行榜历史
+#
+############################################################################################
+@pytest.fixture
+def history(monkeypatch, tmp_path):
+    monkeypatch.setattr(server, 'HISTORY_DB', str(tmp_path / 'history.db'))
+    monkeypatch.setattr(server, 'history_db', None)
+    monkeypatch.setattr(server, 'history_last_rows', {})
+    yield
+    server.history_db.close()
+
+def test_deltas_with_missing_rank_or_time(history):
+    server.record_leaderboard_snapshot('club:LB', make_table([{'rank': 1, 'displayName': 'A', 'time': None}, {'rank': None, 'displayName': 'B', 'time': '00:03:10.0000000'}], ('rank', 'displayName', 'time')))
+    server.record_leaderboard_snapshot('club:LB', make_table([{'rank': 1, 'displayName': 'A', 'time': '00:03:00.0000000'}, {'rank': 2, 'displayName': 'B', 'time': '00:03:05.0000000'}], ('rank', 'displayName', 'time')))
+    old, new = sorted(snapshot['snapshotID'] for snapshot in server.list_leaderboard_snapshots('club:LB'))
+
+    response = server.app.test_client().get(f'/history/deltas?from={old}&to={new}')
+    assert response.status_code == 200
+    deltas = {delta['displayName']: delta for delta in response.get_json()}
+    assert deltas['A']['timeImproved'] is None and deltas['A']['rankChange'] == 0
+    assert deltas['B']['rankChange'] is None and deltas['B']['timeImproved'] is True
+
+############################################################################################
+#
+# 请求限速：收到429后暂停到Retry-After之后再发出请求
+#
+############################################################################################
+def test_429_pauses_requests_until_retry_after(monkeypatch):
+    monkeypatch.setattr(server, 'rate_limit_state', {'rate': 10, 'tokens': server.RATE_LIMIT_BURST, 'updated': time.time(), 'blockedUntil': 0})
+    monkeypatch.setattr(server, 'rate_limit_waiters', [])
+    sent = []
+    responses = [FakeResponse(429, headers={'Retry-After': '0.5'}), FakeResponse(200, {})]
+
+    def fake_request(method, url, **kwargs):
+        sent.append(time.time())
+        return responses.pop(0)
+
+    monkeypatch.setattr(server.http_session, 'request', fake_request)
+    response = server.racenet_get('/wrc2023clubs/1')
+
+    assert response.status_code == 200
+    assert len(sent) == 2
+    assert sent[1] - sent[0] >= 0.5
+    # The rate was halved by the 429, then raised a little by the successful retry
+    assert server.rate_limit_state['rate'] == pytest.approx(5 + server.RATE_LIMIT_INCREASE)
+
+@pytest.mark.parametrize('value, expected', [
+    ('3', 3),
+    ('-1', 0),
+    (None, server.RATE_LIMIT_RETRY_AFTER),
+    ('soon', server.RATE_LIMIT_RETRY_AFTER),
+    ('Wed, 21 Oct 2015 07:28:00 GMT', 0),
+])
+def test_parse_retry_after(value, expected):
+    assert server.parse_retry_after(value) == expected